@@ -17,11 +17,24 @@ https://github.com/coolcornucopia/
 
 
 from turtle import Turtle, Screen, mainloop
+import tkinter
 import math
 import locale
 import unicodedata # Use to sort strings with accents, see strip_accents()
 import time
 import random
+import os
+import sys
+import struct
+import zlib
+import json
+import argparse
+import bisect
+import socket
+import multiprocessing
+import mmap
+import hashlib
+import base64
 import pycountry
 
 
@@ -34,78 +47,258 @@ FLAG_DEFAULT_RATIO = 2/3  # preferred flag ratio size between width & height
 
 FULLSCREEN = True
 
+METRICS = True  # write the gameplay metrics files, see GAMEPLAY METRICS
+
 DEBUG = False
 #DEBUG = True
 
 
 ### GLOBAL VARIABLES ###
 
-# This is our "current turtle (ct)"
-ct = Turtle()
+# This is our "current turtle (ct)", the window is only opened by
+# setup_screen() so the headless tools (see HEADLESS RENDERING) can run
+# without a display
+ct = None
+screen = None
+# Hidden turtle writing the game messages, so ct.clear() keeps them. Shared
+# by all the games, a turtle can not be removed from the screen.
+writer = None
+
+def setup_screen():
+    global ct, screen, writer
+    ct = Turtle()
+    writer = Turtle()
+    writer.hideturtle()
+    writer.penup()
+    # TODO (resolution, default white background)
+    screen = Screen()
+    if FULLSCREEN:
+        screen.setup(width = 1.0, height = 1.0)
+
+
+### RENDER CONTEXTS ###
+
+# A render context carries the drawing target (a turtle, a RecordingTurtle
+# or any object with the turtle methods used here), the current color and
+# a transform (scale then offset) applied to the positions and lengths.
+# The drawing helpers, flag_* functions, gallery and games take an optional
+# "ctx": without it they draw with the global turtle "ct" like before, with
+# their own contexts several flags render independently (threads,
+# processes, off-screen targets).
+class RenderContext(object):
+    def __init__(self, target=None, scale=1, dx=0, dy=0, fast=True,
+                 size=None):
+        self.target = target
+        self.current_color = None
+        self.scale = scale
+        self.dx = dx
+        self.dy = dy
+        self.fast = fast  # see update_configure()
+        self.size = size  # window (width, height) of off-screen targets
+
+    # No target: the global turtle (created by setup_screen())
+    @property
+    def turtle(self):
+        return ct if self.target is None else self.target
+
+    # Tk screen of the target, None for off-screen targets
+    def screen(self):
+        getscreen = getattr(self.turtle, 'getscreen', None)
+        return getscreen() if getscreen is not None else None
+
+    # (width, height) of the target screen, "size" for off-screen targets
+    def window_size(self):
+        target_screen = self.screen()
+        if target_screen is None:
+            return self.size
+        return target_screen.window_width(), target_screen.window_height()
+
+    def penup(self):
+        self.turtle.penup()
+
+    def pendown(self):
+        self.turtle.pendown()
+
+    def isdown(self):
+        return self.turtle.isdown()
+
+    def pensize(self, width=None):
+        return self.turtle.pensize(width)
+
+    # The colors set last (turtle color() arguments) are kept, setting them
+    # again is not sent to the target (a Tk turtle redraws itself at each
+    # color() call). So the target color must only be set through its
+    # context.
+    def color(self, *args):
+        if args != self.current_color:
+            self.current_color = args
+            self.turtle.color(*args)
+
+    def setheading(self, angle):
+        self.turtle.setheading(angle)
+
+    def right(self, angle):
+        self.turtle.right(angle)
+
+    def left(self, angle):
+        self.turtle.left(angle)
+
+    def goto(self, x, y=None):
+        if y is None:
+            x, y = x
+        self.turtle.goto(x * self.scale + self.dx, y * self.scale + self.dy)
+
+    def forward(self, distance):
+        self.turtle.forward(distance * self.scale)
+
+    def circle(self, radius):
+        self.turtle.circle(radius * self.scale)
+
+    def begin_fill(self):
+        self.turtle.begin_fill()
+
+    def end_fill(self):
+        self.turtle.end_fill()
+
+    # Filled polygons (with their outline) in one batch, the target may
+    # provide polygons_filled() (RecordingTurtle), a Tk turtle without
+    # animation gets canvas polygons (see tk_polygons_filled()), else they
+    # are drawn one by one with the turtle
+    def polygons_filled(self, polygons):
+        scale, dx, dy = self.scale, self.dx, self.dy
+        if (scale, dx, dy) != (1, 0, 0):
+            polygons = [[(x * scale + dx, y * scale + dy) for x, y in poly]
+                        for poly in polygons]
+        self._polygons_filled(polygons)
+
+    def _polygons_filled(self, polygons):
+        turtle = self.turtle
+        batch = getattr(turtle, 'polygons_filled', None)
+        if batch is not None:
+            batch(polygons)
+            return
+        target_screen = self.screen()
+        if self.fast and hasattr(target_screen, '_createpoly'):
+            tk_polygons_filled(turtle, target_screen, polygons)
+            return
+        for poly in polygons:
+            turtle.penup()
+            turtle.goto(poly[0])
+            turtle.pendown()
+            turtle.begin_fill()
+            for point in poly[1:]:
+                turtle.goto(point)
+            turtle.end_fill()
+
+    # Motif instances, the target may keep them as a motif and transforms
+    # (WireRecorder), else they are drawn as polygons
+    def motif_filled(self, motif, transforms):
+        scale, dx, dy = self.scale, self.dx, self.dy
+        if (scale, dx, dy) != (1, 0, 0):
+            transforms = [(x * scale + dx, y * scale + dy, k * scale, r)
+                          for x, y, k, r in transforms]
+        batch = getattr(self.turtle, 'motif_filled', None)
+        if batch is not None:
+            batch(motif, transforms)
+        else:
+            self._polygons_filled(motif.instances(transforms))
+
+    def write(self, *args, **kwargs):
+        self.turtle.write(*args, **kwargs)
+
+    def clear(self):
+        self.turtle.clear()
 
-# TODO (resolution, default white background)
-screen = Screen()
-if FULLSCREEN:
-    screen.setup(width = 1.0, height = 1.0)
+default_context = RenderContext(fast=fast_draw)
+
+# Batch for a Tk turtle with the tracer off: one canvas polygon per shape,
+# filled and outlined with the turtle colors and pen size, instead of a
+# goto (and a canvas line update) per point. It uses the turtle internals
+# end_fill() uses: the items are added to the turtle items, so clear()
+# removes them, and the turtle line is restarted above them.
+def tk_polygons_filled(turtle, target_screen, polygons):
+    if not polygons:
+        return
+    turtle._newLine()
+    for poly in polygons:
+        item = target_screen._createpoly()
+        turtle.items.append(item)
+        target_screen._drawpoly(item, poly, fill=turtle._fillcolor,
+                                outline=turtle._pencolor,
+                                width=turtle._pensize)
+    # Same final state as drawing the last polygon
+    turtle.penup()
+    turtle.goto(polygons[-1][0])
+    turtle.pendown()
+    turtle._newLine()
+
+def get_context(ctx=None):
+    return default_context if ctx is None else ctx
 
 
 ### DRAWING PRIMITIVES ###
 
 # Useful fonction to move the pen and reset the turtle orientation
-def prepare_drawing(x, y, rotation=0):
-    ct.penup()
-    ct.goto(x, y)
+def prepare_drawing(x, y, rotation=0, ctx=None):
+    ctx = get_context(ctx)
+    ctx.penup()
+    ctx.goto(x, y)
     # The orientation is set by default to the right.
     # In standard mode: 0=east 90=north 180=west 270=south
     # In logo mode: 0=north 90=east 180=south 270=west
     # Here we are in the standard mode
     # rotation parameter is then counter-clockwise
-    ct.setheading(rotation)
-    ct.pendown()
+    ctx.setheading(rotation)
+    ctx.pendown()
 
-def rectangle(x, y, width, height):
-    prepare_drawing(x, y)
+def rectangle(x, y, width, height, ctx=None):
+    ctx = get_context(ctx)
+    prepare_drawing(x, y, ctx=ctx)
     # Note: we may use a loop but it does not bring that much
-    ct.forward(width)
-    ct.right(90)
-    ct.forward(height)
-    ct.right(90)
-    ct.forward(width)
-    ct.right(90)
-    ct.forward(height)
-
-def rectangle_filled(x, y, width, height):
-    ct.begin_fill()
-    rectangle(x, y, width, height)
-    ct.end_fill()
-
-def square(x, y, width):
-    rectangle(x, y, width, width)
-
-def square_filled(x, y, width):
-    rectangle_filled(x, y, width, width)
+    ctx.forward(width)
+    ctx.right(90)
+    ctx.forward(height)
+    ctx.right(90)
+    ctx.forward(width)
+    ctx.right(90)
+    ctx.forward(height)
+
+def rectangle_filled(x, y, width, height, ctx=None):
+    ctx = get_context(ctx)
+    ctx.begin_fill()
+    rectangle(x, y, width, height, ctx=ctx)
+    ctx.end_fill()
+
+def square(x, y, width, ctx=None):
+    rectangle(x, y, width, width, ctx=ctx)
+
+def square_filled(x, y, width, ctx=None):
+    rectangle_filled(x, y, width, width, ctx=ctx)
 
 # For the circle, use the diameter instead of the radius because it is
 # then easier to make objects touch themselves, avoiding x2 in user code.
-def circle(center_x, center_y, diameter):
+def circle(center_x, center_y, diameter, ctx=None):
+    ctx = get_context(ctx)
     # Move the circle center following Turtle circle() usage
-    prepare_drawing(center_x, center_y - diameter / 2)
-    ct.circle(diameter / 2)
+    prepare_drawing(center_x, center_y - diameter / 2, ctx=ctx)
+    ctx.circle(diameter / 2)
 
-def circle_filled(center_x, center_y, diameter):
-    ct.begin_fill()
-    circle(center_x, center_y, diameter)
-    ct.end_fill()
+def circle_filled(center_x, center_y, diameter, ctx=None):
+    ctx = get_context(ctx)
+    ctx.begin_fill()
+    circle(center_x, center_y, diameter, ctx=ctx)
+    ctx.end_fill()
 
 # The cross is inside a "width" diameter circle
-def cross(center_x, center_y, width):
+def cross(center_x, center_y, width, ctx=None):
+    ctx = get_context(ctx)
     # Move on the cross left then draw
-    prepare_drawing(center_x - (width / 2), center_y)
-    ct.forward(width)
+    prepare_drawing(center_x - (width / 2), center_y, ctx=ctx)
+    ctx.forward(width)
     # Move on the cross top then draw
-    prepare_drawing(center_x, center_y + (width / 2))
-    ct.right(90)
-    ct.forward(width)
+    prepare_drawing(center_x, center_y + (width / 2), ctx=ctx)
+    ctx.right(90)
+    ctx.forward(width)
 
 
 # This five pointed star function draws a star "standing with arms open
@@ -114,7 +307,8 @@ def cross(center_x, center_y, width):
 # other shapes. The drawing algorithm has been adapted from
 # https://stackoverflow.com/questions/26356543/turtle-graphics-draw-a-star
 # TODO better document rotation (clockwise here)
-def five_pointed_star(center_x, center_y, width, rotation=0):
+# Surrounding rectangle (x, y, width, height) of a five pointed star
+def five_pointed_star_box(center_x, center_y, width):
     # https://rechneronline.de/pi/pentagon.php
     # d = width
     # a = pentagon side = 0,618 * d
@@ -124,52 +318,108 @@ def five_pointed_star(center_x, center_y, width, rotation=0):
     d = width
     h = 0.951 * d
     rc = 0.526 * d
+    return center_x - d / 2, center_y + rc, d, h
+
+def five_pointed_star(center_x, center_y, width, rotation=0, ctx=None):
+    ctx = get_context(ctx)
+    d = width
 
     # Default: angle = 144 for a straight star, we may try different
     # values for a more or less pointed star...
     angle = 144
     branch = d / 2.6
-    prepare_drawing(center_x + d / 2 - branch, center_y + d / 6, rotation)
+    prepare_drawing(center_x + d / 2 - branch, center_y + d / 6, rotation, ctx=ctx)
 
     for _ in range(5):
-        ct.forward(branch)
-        ct.right(angle)
-        ct.forward(branch)
-        ct.right((360 / 5) - angle)
+        ctx.forward(branch)
+        ctx.right(angle)
+        ctx.forward(branch)
+        ctx.right((360 / 5) - angle)
 
     # Surrounding rectangle, uncomment to test
-    # rectangle(center_x - d / 2, center_y + rc, d, h)
+    # rectangle(*five_pointed_star_box(center_x, center_y, d))
     # Circumscribed circle, uncomment to test
-    # circle(center_x, center_y, rc * 2)
+    # circle(center_x, center_y, 0.526 * d * 2)
 
     # Return surrounding rectangle coordinates and sizes.
-    return center_x - d / 2, center_y + rc, d, h
+    return five_pointed_star_box(center_x, center_y, d)
+
+# A motif is a shape computed once at unit size (a list of points relative
+# to its anchor) and drawn many times with (x, y, scale, rotation)
+# transforms: all the instances are computed in one pass and given to the
+# target as one batch (see RenderContext.polygons_filled()).
+class Motif(object):
+    def __init__(self, points):
+        self.points = points
+
+    def instances(self, transforms):
+        points = self.points
+        polygons = []
+        for x, y, scale, rotation in transforms:
+            angle = math.radians(rotation)
+            c = math.cos(angle) * scale
+            s = math.sin(angle) * scale
+            polygons.append([(x + px * c - py * s, y + px * s + py * c)
+                             for px, py in points])
+        return polygons
+
+def motif_filled(motif, transforms, ctx=None):
+    get_context(ctx).motif_filled(motif, transforms)
+
+# The path of five_pointed_star() for a width of 1, anchored on its first
+# point, computed once
+def unit_star_points():
+    branch = 1 / 2.6
+    angle = 144
+    points = [(0.0, 0.0)]
+    x = y = heading = 0.0
+    for _ in range(5):
+        for turn in (angle, (360 / 5) - angle):
+            x += branch * math.cos(math.radians(heading))
+            y += branch * math.sin(math.radians(heading))
+            points.append((x, y))
+            heading -= turn
+    return points
+
+STAR_MOTIF = Motif(unit_star_points())
+
+# Motif transform of a five_pointed_star() (which turns around its first
+# point, not its center)
+def star_transform(center_x, center_y, width, rotation=0):
+    return (center_x + width / 2 - width / 2.6, center_y + width / 6,
+            width, rotation)
+
+# Several filled stars in one batch, stars are (center_x, center_y, width,
+# rotation) as for five_pointed_star_filled()
+def five_pointed_stars_filled(stars, ctx=None):
+    motif_filled(STAR_MOTIF, [star_transform(*star) for star in stars], ctx)
 
 # (read five_pointed_star() above function description for details)
-def five_pointed_star_filled(center_x, center_y, width, rotation=0):
-    ct.begin_fill()
-    x, y, w, h = five_pointed_star(center_x, center_y, width, rotation)
-    ct.end_fill()
-    return x, y, w, h
-
-def polygon(poly):
-    ct.penup()
+def five_pointed_star_filled(center_x, center_y, width, rotation=0, ctx=None):
+    five_pointed_stars_filled([(center_x, center_y, width, rotation)], ctx)
+    return five_pointed_star_box(center_x, center_y, width)
+
+def polygon(poly, ctx=None):
+    ctx = get_context(ctx)
+    ctx.penup()
     for x, y in poly:
-        ct.goto(x, y)
-        if not ct.isdown():
-            ct.pendown()
-    ct.goto(tuple(poly[0])) # close the polygon
+        ctx.goto(x, y)
+        if not ctx.isdown():
+            ctx.pendown()
+    ctx.goto(tuple(poly[0])) # close the polygon
 
-def polygon_filled(poly):
-    ct.begin_fill()
-    polygon(poly)
-    ct.end_fill()
+def polygon_filled(poly, ctx=None):
+    ctx = get_context(ctx)
+    ctx.begin_fill()
+    polygon(poly, ctx=ctx)
+    ctx.end_fill()
 
 
 ### HELPER FUNCTIONS FOR FLAGS DRAWING ###
 
 # TODO better document below functions
-def vertical_strips(x, y, width, height, *colors):
+def vertical_strips(x, y, width, height, *colors, ctx=None):
+    ctx = get_context(ctx)
     nc = len(colors)
     if nc <= 0:
         # TODO Better manage error here below
@@ -177,10 +427,11 @@ def vertical_strips(x, y, width, height, *colors):
         return
     w = width / nc  # TODO round?
     for i in range(nc):
-        ct.color(colors[i])
-        rectangle_filled(x + i * w, y, w, height)
+        ctx.color(colors[i])
+        rectangle_filled(x + i * w, y, w, height, ctx=ctx)
 
-def horizontal_strips(x, y, width, height, *colors):
+def horizontal_strips(x, y, width, height, *colors, ctx=None):
+    ctx = get_context(ctx)
     nc = len(colors)
     if nc <= 0:
         # TODO Better manage error here below
@@ -188,48 +439,54 @@ def horizontal_strips(x, y, width, height, *colors):
         return
     h = height / nc  # TODO round?
     for i in range(nc):
-        ct.color(colors[i])
-        rectangle_filled(x, y - i * h, width, h)
+        ctx.color(colors[i])
+        rectangle_filled(x, y - i * h, width, h, ctx=ctx)
 
 # TODO Document parameters
 def rectangle_circle(x, y, width, height,
                      circ_center_x_r, circ_center_y_r,
-                     circ_diam_r, background_col, circ_col):
-    ct.color(background_col)
-    rectangle_filled(x, y, width, height)
-    ct.color(circ_col)
+                     circ_diam_r, background_col, circ_col, ctx=None):
+    ctx = get_context(ctx)
+    ctx.color(background_col)
+    rectangle_filled(x, y, width, height, ctx=ctx)
+    ctx.color(circ_col)
     circ_center_x = x + width * circ_center_x_r
     circ_center_y = y - height * circ_center_y_r
     diameter = width * circ_diam_r
-    circle_filled(circ_center_x, circ_center_y, diameter)
+    circle_filled(circ_center_x, circ_center_y, diameter, ctx=ctx)
 
 # TODO Document parameters
 def cross_filled(x, y, width, height,
                  cross_center_x_r, cross_center_y_r,
-                 cross_width_r, cross_height_r, col):
-    ct.color(col)
+                 cross_width_r, cross_height_r, col, ctx=None):
+    ctx = get_context(ctx)
+    ctx.color(col)
     w = width * cross_width_r
     h = height * cross_height_r
     x1 = x + width * cross_center_x_r - (w / 2)
     y1 = y - height * cross_center_y_r + (h / 2)
-    rectangle_filled(x1, y, w, height)
-    rectangle_filled(x, y1, width, h)
+    rectangle_filled(x1, y, w, height, ctx=ctx)
+    rectangle_filled(x, y1, width, h, ctx=ctx)
 
-def rectangle_filled_color(x, y, width, height, color):
-    ct.color(color)
-    rectangle_filled(x, y, width, height)
+def rectangle_filled_color(x, y, width, height, color, ctx=None):
+    ctx = get_context(ctx)
+    ctx.color(color)
+    rectangle_filled(x, y, width, height, ctx=ctx)
 
-def circle_filled_color(center_x, center_y, diameter, color):
-    ct.color(color)
-    circle_filled(center_x, center_y, diameter)
+def circle_filled_color(center_x, center_y, diameter, color, ctx=None):
+    ctx = get_context(ctx)
+    ctx.color(color)
+    circle_filled(center_x, center_y, diameter, ctx=ctx)
 
-def five_pointed_star_filled_color(center_x, center_y, width, color, rotation=0):
-    ct.color(color)
-    five_pointed_star_filled(center_x, center_y, width, rotation)
+def five_pointed_star_filled_color(center_x, center_y, width, color, rotation=0, ctx=None):
+    ctx = get_context(ctx)
+    ctx.color(color)
+    five_pointed_star_filled(center_x, center_y, width, rotation, ctx=ctx)
 
-def polygon_filled_color(poly, color):
-    ct.color(color)
-    polygon_filled(poly)
+def polygon_filled_color(poly, color, ctx=None):
+    ctx = get_context(ctx)
+    ctx.color(color)
+    polygon_filled(poly, ctx=ctx)
 
 def circle_coord(center_x, center_y, radius, angle_pc):
     angle_rad = (2 * math.pi) * angle_pc
@@ -243,153 +500,156 @@ def circle_coord(center_x, center_y, radius, angle_pc):
 # Note Following functions do not take into account directly the
 # aspect ratio and the border, so you can use them directly
 # depending of your need... or via the class with proper aspect ratio :-)
-def flag_Armenia(x, y, width, height):
-    horizontal_strips(x, y, width, height, '#D90012', '#0033A0', '#F2A800')
+def flag_Armenia(x, y, width, height, ctx=None):
+    horizontal_strips(x, y, width, height, '#D90012', '#0033A0', '#F2A800', ctx=ctx)
 
-def flag_Austria(x, y, width, height):
-    horizontal_strips(x, y, width, height, '#ED2939', 'white', '#ED2939')
+def flag_Austria(x, y, width, height, ctx=None):
+    horizontal_strips(x, y, width, height, '#ED2939', 'white', '#ED2939', ctx=ctx)
 
-def flag_Bahamas(x, y, width, height):
-    horizontal_strips(x, y, width, height, '#00778B', '#FFC72C', '#00778B')
+def flag_Bahamas(x, y, width, height, ctx=None):
+    horizontal_strips(x, y, width, height, '#00778B', '#FFC72C', '#00778B', ctx=ctx)
     polygon_filled_color(((x, y), (x + width/2.3, y - height/2),
-                          (x, y - height)), 'black')
+                          (x, y - height)), 'black', ctx=ctx)
 
-def flag_Bahrain(x, y, width, height):
-    rectangle_filled_color(x, y, width/4, height, 'white')
-    rectangle_filled_color(x+width/4, y, 3*width/4, height, '#F21731')
+def flag_Bahrain(x, y, width, height, ctx=None):
+    rectangle_filled_color(x, y, width/4, height, 'white', ctx=ctx)
+    rectangle_filled_color(x+width/4, y, 3*width/4, height, '#F21731', ctx=ctx)
     polygon_filled_color(((x + width/4, y), (x + 2*width/5, y - height/10),
-                          (x + width/4, y - height/5)), 'white')
+                          (x + width/4, y - height/5)), 'white', ctx=ctx)
     polygon_filled_color(((x + width/4, y-height/5), (x + 2*width/5, y - 3*height/10),
-                          (x + width/4, y - 2*height/5)), 'white')
+                          (x + width/4, y - 2*height/5)), 'white', ctx=ctx)
     polygon_filled_color(((x + width/4, y-2*height/5), (x + 2*width/5, y - height/2),
-                          (x + width/4, y - 3*height/5)), 'white')
+                          (x + width/4, y - 3*height/5)), 'white', ctx=ctx)
     polygon_filled_color(((x + width/4, y-3*height/5), (x + 2*width/5, y - 7*height/10),
-                          (x + width/4, y - 4*height/5)), 'white')
+                          (x + width/4, y - 4*height/5)), 'white', ctx=ctx)
     polygon_filled_color(((x + width/4, y-4*height/5), (x + 2*width/5, y - 9*height/10),
-                          (x + width/4, y - height)), 'white')
+                          (x + width/4, y - height)), 'white', ctx=ctx)
 
-def flag_Bangladesh(x, y, width, height):
+def flag_Bangladesh(x, y, width, height, ctx=None):
     rectangle_circle(x, y, width, height, 45/100, 1/2, 2/5,
-                     '#006a4e', '#f42a41')
+                     '#006a4e', '#f42a41', ctx=ctx)
 
-def flag_Belgium(x, y, width, height):
-    vertical_strips(x, y, width, height, 'black', '#FAE042', '#ED2939')
+def flag_Belgium(x, y, width, height, ctx=None):
+    vertical_strips(x, y, width, height, 'black', '#FAE042', '#ED2939', ctx=ctx)
 
-def flag_Benin(x, y, width, height):
-    horizontal_strips(x, y, width, height, '#FCD116', '#E8112D')
-    rectangle_filled_color(x, y, width / 2.5, height, '#008751')
+def flag_Benin(x, y, width, height, ctx=None):
+    horizontal_strips(x, y, width, height, '#FCD116', '#E8112D', ctx=ctx)
+    rectangle_filled_color(x, y, width / 2.5, height, '#008751', ctx=ctx)
 
-def flag_Bolivia(x, y, width, height):
-    horizontal_strips(x, y, width, height, '#D52B1E', '#F9E300', '#007934')
+def flag_Bolivia(x, y, width, height, ctx=None):
+    horizontal_strips(x, y, width, height, '#D52B1E', '#F9E300', '#007934', ctx=ctx)
     # TODO Please finalize me
 
-def flag_Botswana(x, y, width, height):
-    rectangle_filled_color(x, y, width, height, '#6DA9D2')
-    rectangle_filled_color(x, y - height * 3/8, width, height/4, 'white')
-    rectangle_filled_color(x, y - height/2.4, width, height/6, 'black')
+def flag_Botswana(x, y, width, height, ctx=None):
+    rectangle_filled_color(x, y, width, height, '#6DA9D2', ctx=ctx)
+    rectangle_filled_color(x, y - height * 3/8, width, height/4, 'white', ctx=ctx)
+    rectangle_filled_color(x, y - height/2.4, width, height/6, 'black', ctx=ctx)
 
-def flag_Bulgaria(x, y, width, height):
-    horizontal_strips(x, y, width, height, 'white', '#00966E', '#D62612')
+def flag_Bulgaria(x, y, width, height, ctx=None):
+    horizontal_strips(x, y, width, height, 'white', '#00966E', '#D62612', ctx=ctx)
 
-def flag_Burkina_Faso(x, y, width, height):
-    horizontal_strips(x, y, width, height, '#EF2B2D', '#009E49')
-    five_pointed_star_filled_color(x + width/2, y - height/2, 2*width/9, '#FCD116')
+def flag_Burkina_Faso(x, y, width, height, ctx=None):
+    horizontal_strips(x, y, width, height, '#EF2B2D', '#009E49', ctx=ctx)
+    five_pointed_star_filled_color(x + width/2, y - height/2, 2*width/9, '#FCD116', ctx=ctx)
 
-def flag_Cameroon(x, y, width, height):
-    vertical_strips(x, y, width, height, '#007A5E', '#CE1126', '#FCD116')
-    five_pointed_star_filled_color(x + width/2, y - height/2, width/6, '#FCD116')
+def flag_Cameroon(x, y, width, height, ctx=None):
+    vertical_strips(x, y, width, height, '#007A5E', '#CE1126', '#FCD116', ctx=ctx)
+    five_pointed_star_filled_color(x + width/2, y - height/2, width/6, '#FCD116', ctx=ctx)
 
-def flag_Chile(x, y, width, height):
-    horizontal_strips(x, y, width, height, 'white', '#d52b1e')
-    rectangle_filled_color(x, y, width/3, height/2, '#0039a6')
-    five_pointed_star_filled_color(x + width/6, y - height/4, width/6, 'white')
+def flag_Chile(x, y, width, height, ctx=None):
+    horizontal_strips(x, y, width, height, 'white', '#d52b1e', ctx=ctx)
+    rectangle_filled_color(x, y, width/3, height/2, '#0039a6', ctx=ctx)
+    five_pointed_star_filled_color(x + width/6, y - height/4, width/6, 'white', ctx=ctx)
 
-def flag_China(x, y, width, height):
-    rectangle_filled_color(x, y, width, height, '#DE2910')
+def flag_China(x, y, width, height, ctx=None):
+    ctx = get_context(ctx)
+    rectangle_filled_color(x, y, width, height, '#DE2910', ctx=ctx)
     bsw = width * 19 / 100 # big star width
     ssw = bsw / 3          # small star width
-    ct.color('#FFDE00')
-    five_pointed_star_filled(x + width * 1/6, y - height * 1/4, bsw)
-    five_pointed_star_filled(x + width * 1/3, y - height * 1/10, ssw, 360-23)
-    five_pointed_star_filled(x + width * 2/5, y - height * 1/5, ssw, 360-46)
-    five_pointed_star_filled(x + width * 2/5, y - height * 7/20, ssw, 360-70)
-    five_pointed_star_filled(x + width * 1/3, y - height * 9/20, ssw, 360-21)
+    ctx.color('#FFDE00')
+    five_pointed_stars_filled([
+        (x + width * 1/6, y - height * 1/4, bsw, 0),
+        (x + width * 1/3, y - height * 1/10, ssw, 360-23),
+        (x + width * 2/5, y - height * 1/5, ssw, 360-46),
+        (x + width * 2/5, y - height * 7/20, ssw, 360-70),
+        (x + width * 1/3, y - height * 9/20, ssw, 360-21)], ctx=ctx)
     
-def flag_Colombia(x, y, width, height):
-    rectangle_filled_color(x, y, width, height/2, '#FCD116')
-    rectangle_filled_color(x, y-height/2, width, height/4, '#003893')
-    rectangle_filled_color(x, y-3*height/4, width, height/4, '#CE1126')
+def flag_Colombia(x, y, width, height, ctx=None):
+    rectangle_filled_color(x, y, width, height/2, '#FCD116', ctx=ctx)
+    rectangle_filled_color(x, y-height/2, width, height/4, '#003893', ctx=ctx)
+    rectangle_filled_color(x, y-3*height/4, width, height/4, '#CE1126', ctx=ctx)
 
-def flag_Costa_Rica(x, y, width, height):
-    rectangle_filled_color(x, y, width, height, '#001489')
-    rectangle_filled_color(x, y - height/6, width, 2*height/3, 'white')
-    rectangle_filled_color(x, y - height/3, width, height/3, '#DA291C')
+def flag_Costa_Rica(x, y, width, height, ctx=None):
+    rectangle_filled_color(x, y, width, height, '#001489', ctx=ctx)
+    rectangle_filled_color(x, y - height/6, width, 2*height/3, 'white', ctx=ctx)
+    rectangle_filled_color(x, y - height/3, width, height/3, '#DA291C', ctx=ctx)
 
-def flag_Cuba(x, y, width, height):
-    horizontal_strips(x, y, width, height, '#002590', 'white', '#002590', 'white', '#002590')
-    polygon_filled_color(((x, y), (x + ((3)**(1/2))*width/4, y - height/2), (x, y - height)), '#CC0D0D')
-    five_pointed_star_filled_color(x + (0.57735)*width/4, y - height/2, width/6, 'white')
+def flag_Cuba(x, y, width, height, ctx=None):
+    horizontal_strips(x, y, width, height, '#002590', 'white', '#002590', 'white', '#002590', ctx=ctx)
+    polygon_filled_color(((x, y), (x + ((3)**(1/2))*width/4, y - height/2), (x, y - height)), '#CC0D0D', ctx=ctx)
+    five_pointed_star_filled_color(x + (0.57735)*width/4, y - height/2, width/6, 'white', ctx=ctx)
 
-def flag_Czechia(x, y, width, height):
-    horizontal_strips(x, y, width, height, 'white', '#D7141A')
-    polygon_filled_color(((x, y), (x + width/2, y - height/2), (x, y - height)), '#11457E')
+def flag_Czechia(x, y, width, height, ctx=None):
+    horizontal_strips(x, y, width, height, 'white', '#D7141A', ctx=ctx)
+    polygon_filled_color(((x, y), (x + width/2, y - height/2), (x, y - height)), '#11457E', ctx=ctx)
 
-def flag_Denmark(x, y, width, height):
-    rectangle_filled_color(x, y, width, height, '#C8102E')
-    cross_filled(x, y, width, height, 0.36, 1/2, 16/100, 2/9, 'white')
+def flag_Denmark(x, y, width, height, ctx=None):
+    rectangle_filled_color(x, y, width, height, '#C8102E', ctx=ctx)
+    cross_filled(x, y, width, height, 0.36, 1/2, 16/100, 2/9, 'white', ctx=ctx)
 
-def flag_Estonia(x, y, width, height):
-    horizontal_strips(x, y, width, height, '#0072ce', 'black', 'white')
+def flag_Estonia(x, y, width, height, ctx=None):
+    horizontal_strips(x, y, width, height, '#0072ce', 'black', 'white', ctx=ctx)
 
-def flag_Finland(x, y, width, height):
-    rectangle_filled_color(x, y, width, height, 'white')
-    cross_filled(x, y, width, height, 65/180, 1/2, 1/6, 3/11, '#003580')
+def flag_Finland(x, y, width, height, ctx=None):
+    rectangle_filled_color(x, y, width, height, 'white', ctx=ctx)
+    cross_filled(x, y, width, height, 65/180, 1/2, 1/6, 3/11, '#003580', ctx=ctx)
 
-def flag_France(x, y, width, height):
-    vertical_strips(x, y, width, height, '#002654', 'white', '#ED2939')
+def flag_France(x, y, width, height, ctx=None):
+    vertical_strips(x, y, width, height, '#002654', 'white', '#ED2939', ctx=ctx)
 
-def flag_Gabon(x, y, width, height):
-    horizontal_strips(x, y, width, height, '#009e60', '#fcd116', '#3a75c4')
+def flag_Gabon(x, y, width, height, ctx=None):
+    horizontal_strips(x, y, width, height, '#009e60', '#fcd116', '#3a75c4', ctx=ctx)
 
-def flag_Gambia(x, y, width, height):
-    horizontal_strips(x, y, width, height, '#CE1126', 'white', '#3A7728')
-    rectangle_filled_color(x, y - height/2.57, width, height/4.5, '#0C1C8C')
+def flag_Gambia(x, y, width, height, ctx=None):
+    horizontal_strips(x, y, width, height, '#CE1126', 'white', '#3A7728', ctx=ctx)
+    rectangle_filled_color(x, y - height/2.57, width, height/4.5, '#0C1C8C', ctx=ctx)
 
-def flag_Germany(x, y, width, height):
-    horizontal_strips(x, y, width, height, '#000', '#D00', '#FFCE00')
+def flag_Germany(x, y, width, height, ctx=None):
+    horizontal_strips(x, y, width, height, '#000', '#D00', '#FFCE00', ctx=ctx)
 
-def flag_Greece(x, y, width, height):
+def flag_Greece(x, y, width, height, ctx=None):
     b = '#0D5EAF'
     w = 'white'
-    horizontal_strips(x, y, width, height, *([b, w] * 4 + [b]))
-    rectangle_filled_color(x, y, width * 0.37, height * 5/9 - 1, b)
+    horizontal_strips(x, y, width, height, *([b, w] * 4 + [b]), ctx=ctx)
+    rectangle_filled_color(x, y, width * 0.37, height * 5/9 - 1, b, ctx=ctx)
     cross_filled(x, y, width * 0.37, height * 5/9 - 1, 1/2, 1/2,
-                 1/13.5/0.37, 1/9/(5/9), w)
+                 1/13.5/0.37, 1/9/(5/9), w, ctx=ctx)
 
-def flag_Guinea(x, y, width, height):
-    vertical_strips(x, y, width, height, '#CE1126', '#FCD116', '#009460')
+def flag_Guinea(x, y, width, height, ctx=None):
+    vertical_strips(x, y, width, height, '#CE1126', '#FCD116', '#009460', ctx=ctx)
 
-def flag_Guinea_Bissau(x, y, width, height):
-    horizontal_strips(x, y, width, height, '#FCD116', '#009E49')
-    rectangle_filled_color(x, y, width/3, height, '#CE1126')
-    five_pointed_star_filled_color(x + width/6, y - height/2, width/6, 'black')
+def flag_Guinea_Bissau(x, y, width, height, ctx=None):
+    horizontal_strips(x, y, width, height, '#FCD116', '#009E49', ctx=ctx)
+    rectangle_filled_color(x, y, width/3, height, '#CE1126', ctx=ctx)
+    five_pointed_star_filled_color(x + width/6, y - height/2, width/6, 'black', ctx=ctx)
 
-def flag_Hungary(x, y, width, height):
-    horizontal_strips(x, y, width, height, '#CE2939', '#FFFFFF', '#477050')
+def flag_Hungary(x, y, width, height, ctx=None):
+    horizontal_strips(x, y, width, height, '#CE2939', '#FFFFFF', '#477050', ctx=ctx)
 
-def flag_Iceland(x, y, width, height):
-    rectangle_filled_color(x, y, width, height, '#02529C')
-    cross_filled(x, y, width, height, 0.36, 1/2, 16/100, 2/9, 'white')
-    cross_filled(x, y, width, height, 0.36, 1/2, 8/100, 1/9, '#DC1E35')
+def flag_Iceland(x, y, width, height, ctx=None):
+    rectangle_filled_color(x, y, width, height, '#02529C', ctx=ctx)
+    cross_filled(x, y, width, height, 0.36, 1/2, 16/100, 2/9, 'white', ctx=ctx)
+    cross_filled(x, y, width, height, 0.36, 1/2, 8/100, 1/9, '#DC1E35', ctx=ctx)
 
-def flag_India(x, y, width, height):
-    horizontal_strips(x, y, width, height, '#F93', 'white', '#128807')
+def flag_India(x, y, width, height, ctx=None):
+    ctx = get_context(ctx)
+    horizontal_strips(x, y, width, height, '#F93', 'white', '#128807', ctx=ctx)
     # Draw the Ashoka Chakra (wheel of 24 spokes & half-circles)
     cx = x + width / 2
     cy = y - height / 2
-    circle_filled_color(cx, cy, width * 17.8/100, '#008')
-    circle_filled_color(cx, cy, width * 15.6/100, 'white')
-    circle_filled_color(cx, cy, width * 3.1/100, '#008')
+    circle_filled_color(cx, cy, width * 17.8/100, '#008', ctx=ctx)
+    circle_filled_color(cx, cy, width * 15.6/100, 'white', ctx=ctx)
+    circle_filled_color(cx, cy, width * 3.1/100, '#008', ctx=ctx)
     # Radius of circles linked to the polygon spokes
     radius_internal = width * 12/1350
     radius_middle = width * 42.15/1350
@@ -397,142 +657,145 @@ def flag_India(x, y, width, height):
     angle_spoke = 4.9 / 360 # 4.9 degrees
     for i in [x/24 for x in range(24)]:  # 0/24, 1/24, 2/24...
         ### The polygon spoke
-        ct.color('#008')
-        ct.penup()
-        ct.goto(circle_coord(cx, cy, radius_internal, i))
-        ct.pendown()
-        ct.begin_fill()
-        ct.goto(circle_coord(cx, cy, radius_middle, i - angle_spoke))
-        ct.goto(circle_coord(cx, cy, radius_external, i))
-        ct.goto(circle_coord(cx, cy, radius_middle, i + angle_spoke))
-        ct.goto(circle_coord(cx, cy, radius_internal, i))
-        ct.end_fill()
+        ctx.color('#008')
+        ctx.penup()
+        ctx.goto(circle_coord(cx, cy, radius_internal, i))
+        ctx.pendown()
+        ctx.begin_fill()
+        ctx.goto(circle_coord(cx, cy, radius_middle, i - angle_spoke))
+        ctx.goto(circle_coord(cx, cy, radius_external, i))
+        ctx.goto(circle_coord(cx, cy, radius_middle, i + angle_spoke))
+        ctx.goto(circle_coord(cx, cy, radius_internal, i))
+        ctx.end_fill()
         # The circle
         xx, yy = circle_coord(cx, cy, radius_external, i + 0.5/24)
-        circle_filled_color(xx, yy, width * 10.5/1350, '#008')
+        circle_filled_color(xx, yy, width * 10.5/1350, '#008', ctx=ctx)
 
-def flag_Indonesia(x, y, width, height):
-    horizontal_strips(x, y, width, height, 'red', 'white')
+def flag_Indonesia(x, y, width, height, ctx=None):
+    horizontal_strips(x, y, width, height, 'red', 'white', ctx=ctx)
 
-def flag_Ireland(x, y, width, height):
-    vertical_strips(x, y, width, height, '#169B62', 'white', '#FF883E')
+def flag_Ireland(x, y, width, height, ctx=None):
+    vertical_strips(x, y, width, height, '#169B62', 'white', '#FF883E', ctx=ctx)
 
-def flag_Italy(x, y, width, height):
-    vertical_strips(x, y, width, height, '#008C45', '#F4F5F0', '#CD212A')
+def flag_Italy(x, y, width, height, ctx=None):
+    vertical_strips(x, y, width, height, '#008C45', '#F4F5F0', '#CD212A', ctx=ctx)
 
-def flag_Ivory_Coast(x, y, width, height):
-    vertical_strips(x, y, width, height, '#f77f00', 'white', '#009e60')
+def flag_Ivory_Coast(x, y, width, height, ctx=None):
+    vertical_strips(x, y, width, height, '#f77f00', 'white', '#009e60', ctx=ctx)
     
-def flag_Lithuania(x, y, width, height):
-    horizontal_strips(x, y, width, height, '#FDB913', '#006A44', '#C1282D')
+def flag_Lithuania(x, y, width, height, ctx=None):
+    horizontal_strips(x, y, width, height, '#FDB913', '#006A44', '#C1282D', ctx=ctx)
     
-def flag_Luxembourg(x, y, width, height):
-    horizontal_strips(x, y, width, height, '#EF3340', 'white', '#00A3E0')
+def flag_Luxembourg(x, y, width, height, ctx=None):
+    horizontal_strips(x, y, width, height, '#EF3340', 'white', '#00A3E0', ctx=ctx)
 
-def flag_Madagascar(x, y, width, height):
-    horizontal_strips(x, y, width, height, '#F9423A', '#00843D')
-    rectangle_filled_color(x, y, width/3, height, 'white')
+def flag_Madagascar(x, y, width, height, ctx=None):
+    horizontal_strips(x, y, width, height, '#F9423A', '#00843D', ctx=ctx)
+    rectangle_filled_color(x, y, width/3, height, 'white', ctx=ctx)
 
-def flag_Japan(x, y, width, height):
+def flag_Japan(x, y, width, height, ctx=None):
     rectangle_circle(x, y, width, height, 1/2, 1/2, 2/5,
-                     'white', '#bc002d')
+                     'white', '#bc002d', ctx=ctx)
 
-def flag_Kuwait(x, y, width, height):
-    horizontal_strips(x, y, width, height, '#007A3D', 'white', '#CE1126')
-    polygon_filled_color(((x,y), (x + width/4, y - height/3), (x + width/4, y - 2*height/3), (x, y - height)), 'black')
+def flag_Kuwait(x, y, width, height, ctx=None):
+    horizontal_strips(x, y, width, height, '#007A3D', 'white', '#CE1126', ctx=ctx)
+    polygon_filled_color(((x,y), (x + width/4, y - height/3), (x + width/4, y - 2*height/3), (x, y - height)), 'black', ctx=ctx)
 
-def flag_Mali(x, y, width, height):
-    vertical_strips(x, y, width, height, '#14B53A', '#FCD116', '#CE1126')
+def flag_Mali(x, y, width, height, ctx=None):
+    vertical_strips(x, y, width, height, '#14B53A', '#FCD116', '#CE1126', ctx=ctx)
 
-def flag_Myanmar(x, y, width, height):
-    horizontal_strips(x, y, width, height, '#FECB00', '#34B233', '#EA2839')
+def flag_Myanmar(x, y, width, height, ctx=None):
+    horizontal_strips(x, y, width, height, '#FECB00', '#34B233', '#EA2839', ctx=ctx)
     h = 2 * height / 3
     d = h / 0.951  # See five_pointed_star_filled() computations
-    five_pointed_star_filled_color(x + width / 2, y - height / 1.9, d, 'white')
+    five_pointed_star_filled_color(x + width / 2, y - height / 1.9, d, 'white', ctx=ctx)
 
-def flag_Netherlands(x, y, width, height):
-    horizontal_strips(x, y, width, height, '#A91F32', 'white', '#1E4785')
+def flag_Netherlands(x, y, width, height, ctx=None):
+    horizontal_strips(x, y, width, height, '#A91F32', 'white', '#1E4785', ctx=ctx)
 
-def flag_Nigeria(x, y, width, height):
-    vertical_strips(x, y, width, height, '#008753', 'white', '#008753')
+def flag_Nigeria(x, y, width, height, ctx=None):
+    vertical_strips(x, y, width, height, '#008753', 'white', '#008753', ctx=ctx)
 
-def flag_Pakistan(x, y, width, height):
-    rectangle_filled_color(x, y, width * 1/4, height, 'white')
-    rectangle_circle(x + width * 1/4, y, width * 3/4, height, 0.5, 0.5, 360/675, '#01411C', 'white')
-    circle_filled_color(x + width * 608/900, y - height * 259/600, width * 330/900, '#01411C')
-    ct.color('white')
-    five_pointed_star_filled(x + width * 652/900, y - height * 216/600, width * 114/900, 23)
+def flag_Pakistan(x, y, width, height, ctx=None):
+    ctx = get_context(ctx)
+    rectangle_filled_color(x, y, width * 1/4, height, 'white', ctx=ctx)
+    rectangle_circle(x + width * 1/4, y, width * 3/4, height, 0.5, 0.5, 360/675, '#01411C', 'white', ctx=ctx)
+    circle_filled_color(x + width * 608/900, y - height * 259/600, width * 330/900, '#01411C', ctx=ctx)
+    ctx.color('white')
+    five_pointed_star_filled(x + width * 652/900, y - height * 216/600, width * 114/900, 23, ctx=ctx)
 
-def flag_Peru(x, y , width, height):
-    vertical_strips(x ,y , width, height, '#D91023', 'white', '#D91023')
+def flag_Peru(x, y , width, height, ctx=None):
+    vertical_strips(x ,y , width, height, '#D91023', 'white', '#D91023', ctx=ctx)
 
-def flag_Poland(x, y, width, height):
-    horizontal_strips(x, y, width, height, 'white', '#DC143C')
+def flag_Poland(x, y, width, height, ctx=None):
+    horizontal_strips(x, y, width, height, 'white', '#DC143C', ctx=ctx)
 
-def flag_Romania(x, y, width, height):
-    vertical_strips(x, y, width, height, '#002B7F', '#FCD116', '#CE1126')
+def flag_Romania(x, y, width, height, ctx=None):
+    vertical_strips(x, y, width, height, '#002B7F', '#FCD116', '#CE1126', ctx=ctx)
 
-def flag_Russia(x, y, width, height):
-    horizontal_strips(x, y, width, height, 'white', '#0039A6', '#D52B1E')
+def flag_Russia(x, y, width, height, ctx=None):
+    horizontal_strips(x, y, width, height, 'white', '#0039A6', '#D52B1E', ctx=ctx)
 
-def flag_Senegal(x, y, width, height):
-    vertical_strips(x, y, width, height, '#00853F', '#FDEF42', '#E31B23')
-    five_pointed_star_filled_color(x + width/2, y - height/2, width/6, '#00853F')
+def flag_Senegal(x, y, width, height, ctx=None):
+    vertical_strips(x, y, width, height, '#00853F', '#FDEF42', '#E31B23', ctx=ctx)
+    five_pointed_star_filled_color(x + width/2, y - height/2, width/6, '#00853F', ctx=ctx)
 
-def flag_Seychelles(x, y, width, height):
+def flag_Seychelles(x, y, width, height, ctx=None):
     bl = (x, y - height) # bottom left
     xw = x + width
     w = width / 3
     h = height / 3
-    polygon_filled_color((bl, (x, y), (x + w, y)), '#003F87')
-    polygon_filled_color((bl, (x + w, y), (x + w * 2, y)), '#FCD856')
-    polygon_filled_color((bl, (x + w * 2, y), (xw, y), (xw, y - h)), '#D62828')
-    polygon_filled_color((bl, (xw, y - h), (xw, y - h * 2)), 'white')
-    polygon_filled_color((bl, (xw, y - h * 2), (xw, y - height)), '#007a3d')
+    polygon_filled_color((bl, (x, y), (x + w, y)), '#003F87', ctx=ctx)
+    polygon_filled_color((bl, (x + w, y), (x + w * 2, y)), '#FCD856', ctx=ctx)
+    polygon_filled_color((bl, (x + w * 2, y), (xw, y), (xw, y - h)), '#D62828', ctx=ctx)
+    polygon_filled_color((bl, (xw, y - h), (xw, y - h * 2)), 'white', ctx=ctx)
+    polygon_filled_color((bl, (xw, y - h * 2), (xw, y - height)), '#007a3d', ctx=ctx)
     
-def flag_Sierra_Leone(x,y, width, height):
-    horizontal_strips(x, y, width, height, '#1EB53A', 'white', '#0072C6')
+def flag_Sierra_Leone(x,y, width, height, ctx=None):
+    horizontal_strips(x, y, width, height, '#1EB53A', 'white', '#0072C6', ctx=ctx)
 
-def flag_Somalia(x, y, width, height):
-    rectangle_filled_color(x, y, width, height, '#4189DD')
-    five_pointed_star_filled_color(x + width/2, y - height/2, width/3.28, 'white')
+def flag_Somalia(x, y, width, height, ctx=None):
+    rectangle_filled_color(x, y, width, height, '#4189DD', ctx=ctx)
+    five_pointed_star_filled_color(x + width/2, y - height/2, width/3.28, 'white', ctx=ctx)
 
-def flag_Sudan(x, y, width, height):
-    horizontal_strips(x, y, width, height, '#D21034', 'white', 'black')
-    polygon_filled_color(((x, y),(x + width/3, y - height/2), (x, y - height)), '#007229')
+def flag_Sudan(x, y, width, height, ctx=None):
+    horizontal_strips(x, y, width, height, '#D21034', 'white', 'black', ctx=ctx)
+    polygon_filled_color(((x, y),(x + width/3, y - height/2), (x, y - height)), '#007229', ctx=ctx)
 
-def flag_Sweden(x, y, width, height):
-    rectangle_filled_color(x, y, width, height, '#006AA7')
-    cross_filled(x, y, width, height, 3/8, 1/2, 1/8, 1/5, '#FECC00')
+def flag_Sweden(x, y, width, height, ctx=None):
+    rectangle_filled_color(x, y, width, height, '#006AA7', ctx=ctx)
+    cross_filled(x, y, width, height, 3/8, 1/2, 1/8, 1/5, '#FECC00', ctx=ctx)
 
-def flag_Thailand(x, y, width, height):
-    rectangle_filled_color(x, y, width, height, '#EF3340')
-    rectangle_filled_color(x, y - height/6, width, 2*height/3, 'white')
-    rectangle_filled_color(x, y - height/3, width, height/3, '#00247D')
+def flag_Thailand(x, y, width, height, ctx=None):
+    rectangle_filled_color(x, y, width, height, '#EF3340', ctx=ctx)
+    rectangle_filled_color(x, y - height/6, width, 2*height/3, 'white', ctx=ctx)
+    rectangle_filled_color(x, y - height/3, width, height/3, '#00247D', ctx=ctx)
 
-def flag_Ukraine(x, y, width, height):
-    horizontal_strips(x, y, width, height, '#0057b7', '#ffd700')
+def flag_Ukraine(x, y, width, height, ctx=None):
+    horizontal_strips(x, y, width, height, '#0057b7', '#ffd700', ctx=ctx)
 
-def flag_United_Arab_Emirates(x, y, width, height):
-    horizontal_strips(x, y, width, height, '#00843D', 'white', 'black')
-    rectangle_filled_color(x, y, width/4, height, '#FF0000')
+def flag_United_Arab_Emirates(x, y, width, height, ctx=None):
+    horizontal_strips(x, y, width, height, '#00843D', 'white', 'black', ctx=ctx)
+    rectangle_filled_color(x, y, width/4, height, '#FF0000', ctx=ctx)
 
-def flag_United_States(x, y, width, height):
+def flag_United_States(x, y, width, height, ctx=None):
+    ctx = get_context(ctx)
     # 7 Red & 6 white strips
     r = '#B22234'
     w = 'white'
-    horizontal_strips(x, y, width, height, *([r, w] * 6 + [r])) # r,w,r,w...,r
+    horizontal_strips(x, y, width, height, *([r, w] * 6 + [r]), ctx=ctx) # r,w,r,w...,r
     # The blue rectangle
     # Note - 1 in y-axis for a better alignment
-    rectangle_filled_color(x, y, width / 2.5, 7 * height / 13 - 1, '#3C3B6E')
+    rectangle_filled_color(x, y, width / 2.5, 7 * height / 13 - 1, '#3C3B6E', ctx=ctx)
     # The white stars
-    ct.color('white')
+    ctx.color('white')
     #ct.color('#717095', 'white') # false antialiasing if big flag
     star_width = width / 32.5
     star_height = height / 18.6
     star_width_between = width / 15
     star_y = y - star_height
     stars_in_row = 5
+    stars = []
     for _ in range(9):                 # vertical loop
         if stars_in_row == 6:          # switch between 5 & 6 row stars
             stars_in_row = 5
@@ -541,12 +804,14 @@ def flag_United_States(x, y, width, height):
             stars_in_row = 6
             star_x = x + (star_width_between / 2)
         for _ in range(stars_in_row):  # horizontal loop
-            five_pointed_star_filled(star_x, star_y, star_width)
+            stars.append((star_x, star_y, star_width, 0))
             star_x += star_width_between
         star_y -= star_height
+    # The 50 stars drawn in one batch
+    five_pointed_stars_filled(stars, ctx=ctx)
 
-def flag_Yemen(x, y, width, height):
-    horizontal_strips(x, y, width, height, '#CE1126', 'white', 'black')
+def flag_Yemen(x, y, width, height, ctx=None):
+    horizontal_strips(x, y, width, height, '#CE1126', 'white', 'black', ctx=ctx)
 
 
 ### FLAGS MANAGEMENT FUNCTIONS ###
@@ -557,11 +822,11 @@ class Flag(object):
         self.ratio = ratio
         self.drawing_func = drawing_func
 
-    def draw(self, x, y, width, height):
-        self.drawing_func(x, y, width, height)
+    def draw(self, x, y, width, height, ctx=None):
+        self.drawing_func(x, y, width, height, ctx=ctx)
 
-    def draw_ratio(self, x, y, width):
-        self.drawing_func(x, y, width, width * self.ratio)
+    def draw_ratio(self, x, y, width, ctx=None):
+        self.drawing_func(x, y, width, width * self.ratio, ctx=ctx)
 
 # Dictionnary of all the flags (the key is the flag drawing function)
 flags_dict = dict()
@@ -637,7 +902,151 @@ def strip_accents(s):
 # Sort the flags dictionnary by country code
 sorted(flags_dict.items(), key=lambda x: x[1].country_code)
 
-def game():
+# Country name as displayed, shorter than some pycountry official names
+def country_name(country_code):
+    a = pycountry.countries.get(numeric=country_code).name
+    if a == 'Bolivia, Plurinational State of':
+        a = 'Bolivia'
+    if a == 'Russian Federation':
+        a = 'Russia'
+    if a == "Côte d'Ivoire":
+        a = "Cote d Ivoire"
+    return a
+
+# Expected answer for a flag: the lowercase displayed name, the few
+# pycountry official names are replaced by the ones players actually type
+def country_answer(flag):
+    return country_name(flag.country_code).lower()
+
+### GAMEPLAY METRICS ###
+
+# Production metrics of the game loop, measured with the monotonic clock:
+#   - render: from choosing a flag to the end of random_flags()
+#   - answer: time the player spends answering
+#   - round: end-to-end round duration
+#   - answers: correct/incorrect answers per country code
+# Answer, round and answers series are labelled with the game mode: "type"
+# (the name is typed) or "click" (the flag is clicked in the gallery, its
+# drawing is not part of the round so there is no render time).
+# Histograms have fixed buckets, an update is a bisect and two additions.
+# After each round they are written (if METRICS is set) in Prometheus text
+# format (for the node exporter textfile collector) and as a JSON snapshot.
+
+METRICS_PROM_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'flag_game_metrics.prom')
+METRICS_JSON_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'flag_game_metrics.json')
+
+def _labels_text(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    return '{' + ','.join('%s="%s"' % (k, v) for k, v in items) + '}'
+
+class Histogram(object):
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)  # upper bounds, +Inf is implicit
+        self.series = dict()  # labels -> [counts per bucket, sum, count]
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        serie = self.series.get(key)
+        if serie is None:
+            serie = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        serie[0][bisect.bisect_left(self.buckets, value)] += 1
+        serie[1] += value
+        serie[2] += 1
+
+    def prometheus(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s histogram' % self.name]
+        for key, (counts, total, count) in sorted(self.series.items()):
+            cumul = 0
+            for le, n in zip(self.buckets + ('+Inf',), counts):
+                cumul += n
+                lines.append('%s_bucket%s %d' % (
+                    self.name, _labels_text(key, [('le', le)]), cumul))
+            lines.append('%s_sum%s %r' % (self.name, _labels_text(key), total))
+            lines.append('%s_count%s %d' % (self.name, _labels_text(key), count))
+        return lines
+
+    def snapshot(self):
+        return dict(type='histogram', help=self.help, buckets=self.buckets,
+                    series=[dict(labels=dict(key), counts=counts, sum=total,
+                                 count=count)
+                            for key, (counts, total, count)
+                            in sorted(self.series.items())])
+
+class Counter(object):
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.series = dict()  # labels -> value
+
+    def inc(self, **labels):
+        key = tuple(sorted(labels.items()))
+        self.series[key] = self.series.get(key, 0) + 1
+
+    def prometheus(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s counter' % self.name]
+        for key, value in sorted(self.series.items()):
+            lines.append('%s%s %d' % (self.name, _labels_text(key), value))
+        return lines
+
+    def snapshot(self):
+        return dict(type='counter', help=self.help,
+                    series=[dict(labels=dict(key), value=value)
+                            for key, value in sorted(self.series.items())])
+
+RENDER_SECONDS = Histogram(
+    'flag_game_render_seconds', 'Time from choosing a flag to its drawing end',
+    (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+ANSWER_SECONDS = Histogram(
+    'flag_game_answer_seconds', 'Time spent by the player to answer',
+    (1, 2, 3, 5, 8, 13, 21, 34, 60))
+ROUND_SECONDS = Histogram(
+    'flag_game_round_seconds', 'End-to-end duration of a round',
+    (1, 2, 3, 5, 8, 13, 21, 34, 60))
+ANSWERS_TOTAL = Counter(
+    'flag_game_answers_total', 'Answers per country code and result')
+GAME_METRICS = (RENDER_SECONDS, ANSWER_SECONDS, ROUND_SECONDS, ANSWERS_TOTAL)
+
+def record_round(country_code, correct, t_round, t_drawn, t_answer,
+                 mode='type'):
+    if t_drawn is None:
+        t_drawn = t_round
+    else:
+        RENDER_SECONDS.observe(t_drawn - t_round, country_code=country_code)
+    ANSWER_SECONDS.observe(t_answer - t_drawn, country_code=country_code,
+                           mode=mode)
+    ROUND_SECONDS.observe(time.monotonic() - t_round, mode=mode)
+    ANSWERS_TOTAL.inc(country_code=country_code, mode=mode,
+                      result='correct' if correct else 'incorrect')
+    if METRICS:
+        write_metrics()
+
+def _write_atomic(path, text):
+    # The collector must never read a half written file
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+def write_metrics(prom_path=METRICS_PROM_FILE, json_path=METRICS_JSON_FILE):
+    lines = []
+    for metric in GAME_METRICS:
+        lines += metric.prometheus()
+    _write_atomic(prom_path, '\n'.join(lines) + '\n')
+    snapshot = dict(host=socket.gethostname(), time=time.time(),
+                    metrics=dict((m.name, m.snapshot()) for m in GAME_METRICS))
+    _write_atomic(json_path, json.dumps(snapshot, indent=1))
+
+
+def game(ctx=None):
+    ctx = get_context(ctx)
     points = 0
     score = -1
     flags_dict = dict()
@@ -708,25 +1117,22 @@ def game():
             score = points
             print('Your score =', score)
             return "Done"
+        t_round = time.monotonic()
         b = random.choice(list(flags_dict.keys()))
         flag = flags_dict[b]
         flag_func = flag.drawing_func
-        random_flags(flag_func, ratio=True)
-        nums = flag.country_code
-        country = pycountry.countries.get(numeric=nums)
-        goal = country.name.lower()
-        if goal == "russian federation":
-            goal = 'russia'
-        if goal == "côte d'ivoire":
-            goal = 'cote d ivoire'
-        if goal == 'bolivia, plurinational state of':
-            goal = 'bolivia'
+        random_flags(flag_func, ratio=True, ctx=ctx)
+        t_drawn = time.monotonic()
+        goal = country_answer(flag)
         ans = input("Which flag is it?: ")
+        t_answer = time.monotonic()
         ans = ans.lower()
+        record_round(flag.country_code, ans == goal,
+                     t_round, t_drawn, t_answer)
         if ans == goal:
             points += 1
             print('Correct')
-            ct.clear()
+            ctx.clear()
             del flags_dict[b]
         else:
             score = points
@@ -735,31 +1141,26 @@ def game():
             print('Your score =', score)
     return "Done"
 
-def random_flags(flag_function_name, ratio=True):
+def random_flags(flag_function_name, ratio=True, ctx=None):
+    ctx = get_context(ctx)
     # Get window size
-    win_w = screen.window_width()
-    win_h = screen.window_height()
+    win_w, win_h = ctx.window_size()
     w = win_w * 90/100 # remove 5% borders
     # Get the flag element and draw it according to its size ratio
     flag = flags_dict[flag_function_name]
     if ratio:
         h = w * flag.ratio
-        flag.draw_ratio(-w/2, h/2, w)
+        flag.draw_ratio(-w/2, h/2, w, ctx=ctx)
     else:
         h = w * FLAG_DEFAULT_RATIO
-        flag.draw(-w/2, h/2, w, h)
+        flag.draw(-w/2, h/2, w, h, ctx=ctx)
     # Add a border
-    ct.color(FLAG_BORDER_COL)
-    rectangle(-w/2, h/2, w, h)
+    ctx.color(FLAG_BORDER_COL)
+    rectangle(-w/2, h/2, w, h, ctx=ctx)
 
-def draw_all_flags(width, border, ratio=False):
-    global flags_dict
-    # Get window size
-    window_width = screen.window_width()
-    window_height = screen.window_height()
-    #setup(window_width * 1.0, window_height * 1.0)
-    #print(screensize(), screen.window_width(), screen.window_height())
-    flags_num = len(flags_dict)
+# Position of every flag of the gallery, list of (flag, x, y, w, h) with
+# (x, y) the top left corner in turtle coordinates
+def gallery_layout(width, border, ratio, window_width, window_height):
     x_start = -(window_width / 2) + border # TODO rename border please
     y_start = (window_height / 2) - border
     flags_horiz_max = int((window_width - 2 * border) / width)
@@ -770,74 +1171,1913 @@ def draw_all_flags(width, border, ratio=False):
         flags_horiz_max -= 1
         border_inside = (window_width - (2 * border)) - (flags_horiz_max * width)
         border_inside /= (flags_horiz_max - 1)
+    layout = []
     x = x_start
     y = y_start
-    for i in flags_dict:
-        # Get the flag and draw it
-        flag = flags_dict[i]
-        nums = flag.country_code
-        country = pycountry.countries.get(numeric=nums)
-        a = country.name
+    for flag in flags_dict.values():
         if ratio:
             h = width * flag.ratio
-            flag.draw_ratio(x, y, width)
         else:
             h = width * FLAG_DEFAULT_RATIO
-            flag.draw(x, y, width, h)
+        layout.append((flag, x, y, width, h))
+        # Next flag
+        x += width + border_inside
+        if x > (window_width / 2) - border - width:
+            x = x_start
+            y -= width * 2/3 + border_inside # TODO 2/3 here is not so nice
+    return layout
+
+def draw_all_flags(width, border, ratio=False, names=True, ctx=None):
+    ctx = get_context(ctx)
+    # Get window size
+    window_width, window_height = ctx.window_size()
+    #setup(window_width * 1.0, window_height * 1.0)
+    #print(screensize(), screen.window_width(), screen.window_height())
+    layout = gallery_layout(width, border, ratio, window_width, window_height)
+    for flag, x, y, w, h in layout:
+        # Draw the flag
+        flag.draw(x, y, w, h, ctx=ctx)
 
         # Draw the flag border
-        ct.color(FLAG_BORDER_COL) # TODO find a better way for color config
-        rectangle(x, y, width, h)
+        ctx.color(FLAG_BORDER_COL) # TODO find a better way for color config
+        rectangle(x, y, w, h, ctx=ctx)
 
+        if not names:
+            continue
         # Add the flag name
-        ct.penup()
-        ct.goto(x + width / 2, y)
-        if a == 'Bolivia, Plurinational State of':
-            a = 'Bolivia'
-        if a == 'Russian Federation':
-            a = 'Russia'
-        if a == "Côte d'Ivoire":
-            a = "Cote d Ivoire"
-        ct.write(a, align="center", font=("Arial", 11, "normal"))
+        a = country_name(flag.country_code)
+        ctx.penup()
+        ctx.goto(x + w / 2, y)
+        ctx.write(a, align="center", font=("Arial", 11, "normal"))
         
         a = a.lower()
         print(a)
-        # Next flag
-        x += width + border_inside
-        if x > (window_width / 2) - border - width:
-            x = x_start
-            y -= width * 2/3 + border_inside # TODO 2/3 here is not so nice
+    return layout
+
+
+### IN-WINDOW GAME ###
+
+# The console game blocks on input(), so the Tk window gets no events
+# (no repaint, no resize) while the player thinks. This front end takes
+# the answers from an entry widget inside the window and every round is
+# driven by Tk callbacks from mainloop(), the window stays live.
+
+WINDOW_FPS = 60
+WINDOW_FEEDBACK_DELAY = 800  # ms the "Correct"/"Incorrect" text stays
+
+class WindowGame(object):
+    def __init__(self, ctx=None):
+        self.ctx = get_context(ctx)
+        self.flags = dict(flags_dict)
+        self.points = 0
+        self.flag_key = None
+        self.goal = None
+        self.t_round = self.t_drawn = None
+        self.running = False
+        self.waiting_answer = False
+        # Keystroke-to-feedback latencies (seconds) and frame timestamps
+        self.latencies = []
+        self.frames = []
+        canvas = screen.getcanvas()
+        self.entry = tkinter.Entry(canvas, font=("Arial", 16),
+                                   justify="center")
+        # Turtle (x, y) is canvas (x, -y), put the entry near the bottom
+        self.entry_item = canvas.create_window(
+            0, screen.window_height() / 2 - 40, window=self.entry)
+        self.entry.bind('<Return>', self.on_return)
+        # The feedback is written by the global writer turtle
+        self.writer = writer
+
+    def start(self):
+        self.running = True
+        self.entry.focus_set()
+        self.next_round()
+        self.tick()
+
+    # Refresh the window at WINDOW_FPS while the game is running
+    def tick(self):
+        if not self.running:
+            return
+        self.frames.append(time.perf_counter())
+        update_do(self.ctx)
+        screen.ontimer(self.tick, 1000 // WINDOW_FPS)
+
+    def feedback(self, text, color='black'):
+        self.writer.clear()
+        self.writer.goto(0, -screen.window_height() / 2 + 60)
+        self.writer.color(color)
+        self.writer.write(text, align="center", font=("Arial", 16, "bold"))
+
+    def next_round(self):
+        self.ctx.clear()
+        self.writer.clear()
+        if len(self.flags) == 0:
+            self.feedback('You have achive max score, your score = '
+                          + str(self.points))
+            screen.ontimer(self.finish, WINDOW_FEEDBACK_DELAY * 3)
+            return
+        self.t_round = time.monotonic()
+        self.flag_key = random.choice(list(self.flags.keys()))
+        self.goal = country_answer(self.flags[self.flag_key])
+        random_flags(self.flag_key, ratio=True, ctx=self.ctx)
+        self.t_drawn = time.monotonic()
+        self.waiting_answer = True
+
+    def on_return(self, event):
+        t_key = time.perf_counter()
+        t_answer = time.monotonic()
+        if not self.waiting_answer:
+            return
+        self.waiting_answer = False
+        ans = self.entry.get().strip().lower()
+        self.entry.delete(0, 'end')
+        country_code = self.flags[self.flag_key].country_code
+        if ans == self.goal:
+            self.points += 1
+            del self.flags[self.flag_key]
+            self.feedback('Correct', 'green')
+            next_step = self.next_round
+        else:
+            self.feedback('Incorrect, correct answer: ' + self.goal
+                          + ', your score = ' + str(self.points), 'red')
+            next_step = self.finish
+        # Feedback is on screen once the pending redraw is done
+        screen.update()
+        screen.getcanvas().update_idletasks()
+        self.latencies.append(time.perf_counter() - t_key)
+        record_round(country_code, ans == self.goal,
+                     self.t_round, self.t_drawn, t_answer)
+        screen.ontimer(next_step, WINDOW_FEEDBACK_DELAY)
+
+    def stats(self):
+        s = dict(rounds=len(self.latencies), score=self.points)
+        if self.latencies:
+            s['latency_avg_ms'] = 1000 * sum(self.latencies) / len(self.latencies)
+            s['latency_max_ms'] = 1000 * max(self.latencies)
+        if len(self.frames) > 1:
+            s['fps'] = (len(self.frames) - 1) / (self.frames[-1] - self.frames[0])
+        return s
+
+    # Remove the game widgets and leave mainloop(), back to the menu
+    def finish(self):
+        self.running = False
+        screen.getcanvas().delete(self.entry_item)
+        self.entry.destroy()
+        self.writer.clear()
+        self.ctx.clear()
+        print('Your score =', self.points)
+        if DEBUG:
+            print(self.stats())
+        screen.getcanvas().quit()
+
+def game_window(ctx=None):
+    window_game = WindowGame(ctx)
+    window_game.start()
+    mainloop()
+    return window_game.stats()
+
+
+### CLICK GALLERY GAME ###
+
+# The gallery is shown without names and the player clicks the flag of the
+# asked country. Clicks are resolved with two levels of uniform grids
+# built when the layout is computed: one over the flag tiles, then one
+# per flag over its recorded shapes (strips, stars...), so a click costs
+# a dictionary lookup and a point-in-polygon test on the few shapes of a
+# grid cell instead of a scan of every tile and shape.
+
+GALLERY_WIDTH = 160
+GALLERY_BORDER = 60
+SHAPES_GRID = 8  # cells per tile width for the shapes grid
+
+class GridIndex(object):
+    def __init__(self, cell):
+        self.cell = cell
+        self.cells = dict()
+
+    def insert(self, item, xmin, ymin, xmax, ymax):
+        c = self.cell
+        for cx in range(int(math.floor(xmin / c)), int(math.floor(xmax / c)) + 1):
+            for cy in range(int(math.floor(ymin / c)),
+                            int(math.floor(ymax / c)) + 1):
+                self.cells.setdefault((cx, cy), []).append(item)
+
+    def candidates(self, x, y):
+        c = self.cell
+        return self.cells.get((int(math.floor(x / c)),
+                               int(math.floor(y / c))), ())
+
+def point_in_polygon(x, y, points):
+    # Non-zero winding, same rule as the rasterizer
+    winding = 0
+    n = len(points)
+    for i in range(n):
+        x0, y0 = points[i]
+        x1, y1 = points[(i + 1) % n]
+        if y0 <= y < y1 or y1 <= y < y0:
+            xc = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+            if xc > x:
+                winding += 1 if y1 > y0 else -1
+    return winding != 0
+
+class GalleryTile(object):
+    def __init__(self, flag, x, y, width, height):
+        self.flag = flag
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        # Shapes in turtle coordinates, kept with their drawing order
+        self.shapes = []
+        self.shapes_index = GridIndex(width / SHAPES_GRID)
+        for order, (kind, rgb, _, points) in enumerate(
+                record_flag(flag, width, height)):
+            if kind != 'fill':
+                continue
+            points = [(x + px, y - py) for px, py in points]
+            self.shapes.append((order, rgb, points))
+            xs = [p[0] for p in points]
+            ys = [p[1] for p in points]
+            self.shapes_index.insert(self.shapes[-1], min(xs), min(ys),
+                                     max(xs), max(ys))
+
+    def contains(self, x, y):
+        return (self.x <= x <= self.x + self.width
+                and self.y - self.height <= y <= self.y)
+
+    # Topmost shape (last drawn) under the point, (order, rgb, points)
+    def shape_at(self, x, y):
+        hit = None
+        for shape in self.shapes_index.candidates(x, y):
+            if (hit is None or shape[0] > hit[0]) \
+                    and point_in_polygon(x, y, shape[2]):
+                hit = shape
+        return hit
+
+class Gallery(object):
+    def __init__(self, layout):
+        self.tiles = [GalleryTile(*tile) for tile in layout]
+        cell = max(t.width for t in self.tiles)
+        self.index = GridIndex(cell)
+        for t in self.tiles:
+            self.index.insert(t, t.x, t.y - t.height, t.x + t.width, t.y)
+
+    # (tile, shape) under the point, (None, None) between the flags
+    def hit(self, x, y):
+        for tile in self.index.candidates(x, y):
+            if tile.contains(x, y):
+                return tile, tile.shape_at(x, y)
+        return None, None
+
+class ClickGame(object):
+    def __init__(self, ctx=None):
+        self.ctx = get_context(ctx)
+        self.targets = list(flags_dict.values())
+        random.shuffle(self.targets)
+        self.points = 0
+        self.target = None
+        self.t_round = None
+        self.writer = writer
+        self.ctx.clear()
+        layout = draw_all_flags(GALLERY_WIDTH, GALLERY_BORDER, names=False,
+                                ctx=self.ctx)
+        self.gallery = Gallery(layout)
+        update_do(self.ctx)
+
+    def message(self, text, color='black'):
+        self.writer.clear()
+        self.writer.goto(0, screen.window_height() / 2 - GALLERY_BORDER / 1.5)
+        self.writer.color(color)
+        self.writer.write(text, align="center", font=("Arial", 16, "bold"))
+        update_do(self.ctx)
+
+    def start(self):
+        screen.onclick(self.on_click)
+        self.next_round()
+
+    def next_round(self):
+        if not self.targets:
+            self.message('You have achive max score, your score = '
+                         + str(self.points))
+            screen.ontimer(self.finish, WINDOW_FEEDBACK_DELAY * 3)
+            return
+        self.target = self.targets.pop()
+        self.message('Click the flag of ' + country_name(self.target.country_code))
+        self.t_round = time.monotonic()
+
+    def on_click(self, x, y):
+        if self.target is None:
+            return
+        # The gallery is in the context coordinates
+        ctx = self.ctx
+        tile, shape = self.gallery.hit((x - ctx.dx) / ctx.scale,
+                                       (y - ctx.dy) / ctx.scale)
+        if tile is None:
+            return
+        target, self.target = self.target, None
+        correct = tile.flag is target
+        record_round(target.country_code, correct,
+                     self.t_round, None, time.monotonic(), mode='click')
+        if correct:
+            self.points += 1
+            self.message('Correct', 'green')
+            screen.ontimer(self.next_round, WINDOW_FEEDBACK_DELAY)
+            return
+        clicked = country_name(tile.flag.country_code)
+        if shape is not None:
+            clicked += ' (#%02X%02X%02X part)' % shape[1]
+        self.message('Incorrect, you clicked ' + clicked + ', your score = '
+                     + str(self.points), 'red')
+        screen.ontimer(self.finish, WINDOW_FEEDBACK_DELAY * 3)
+
+    def finish(self):
+        screen.onclick(None)
+        self.writer.clear()
+        self.ctx.clear()
+        print('Your score =', self.points)
+        screen.getcanvas().quit()
+
+def game_click(ctx=None):
+    click_game = ClickGame(ctx)
+    click_game.start()
+    mainloop()
+    return click_game.points
 
 
 ### SCREEN UPDATE HELPERS ###
 
 # TODO rename me + test all parameters
-def update_configure(fast=True, speed=2):
+def update_configure(fast=True, speed=2, ctx=None):
     global fast_draw
-    fast_draw = fast
-    if fast_draw:
+    ctx = get_context(ctx)
+    ctx.fast = fast
+    if ctx is default_context:
+        fast_draw = fast
+    target_screen = ctx.screen()
+    if ctx.fast:
         # Set speed to max   # TODO useful as we use tracer(0)?
-        ct.speed(0)
+        ctx.turtle.speed(0)
         # Hide the turtle
-        ct.hideturtle()
+        ctx.turtle.hideturtle()
         # We will manage when needed the scren update with screen.update()
-        screen.tracer(False)
+        if target_screen is not None:
+            target_screen.tracer(False)
     else:
-        ct.speed(speed)
-        ct.showturtle() # TODO not useful
-        screen.tracer(True) # TODO not useful
-
-def update_do():
-    global fast_draw
-    if fast_draw:
-        screen.update()
+        ctx.turtle.speed(speed)
+        ctx.turtle.showturtle() # TODO not useful
+        if target_screen is not None:
+            target_screen.tracer(True) # TODO not useful
+
+def update_do(ctx=None):
+    ctx = get_context(ctx)
+    target_screen = ctx.screen()
+    if ctx.fast and target_screen is not None:
+        target_screen.update()
+
+
+### HEADLESS RENDERING ###
+
+# The flag functions only talk to a turtle (see RENDER CONTEXTS), so a
+# duck-typed turtle recording the drawn shapes renders them without Tk.
+# Shapes are then rasterized in pure Python into a Raster (RGB bytes).
+
+RASTER_BACKGROUND = (255, 255, 255)
+
+# Tk color names used by the flags, other ones must be written '#RRGGBB'
+COLOR_NAMES = {
+    'white': (255, 255, 255),
+    'black': (0, 0, 0),
+    'red': (255, 0, 0),
+    'green': (0, 128, 0),
+    'blue': (0, 0, 255),
+    'yellow': (255, 255, 0),
+}
+
+_color_cache = dict()  # A flag uses a few colors, resolve each name once
+
+def color_rgb(color):
+    if isinstance(color, tuple):
+        return tuple(int(c) for c in color[:3])
+    rgb = _color_cache.get(color)
+    if rgb is not None:
+        return rgb
+    name = color.strip().lower()
+    if name in COLOR_NAMES:
+        rgb = COLOR_NAMES[name]
+    elif name.startswith('#') and len(name) in (4, 7):
+        digits = name[1:]
+        if len(digits) == 3:
+            digits = ''.join(c * 2 for c in digits)
+        rgb = tuple(int(digits[i:i + 2], 16) for i in (0, 2, 4))
+    else:
+        raise ValueError('Unknown color: ' + repr(color))
+    _color_cache[color] = rgb
+    return rgb
+
+# Records the shapes drawn by the primitives, mimicking turtle behaviors
+# the raster must match: the fill path starts at the position of
+# begin_fill() and collects every position until end_fill(), pen up or
+# down, and circle() uses the same polygon steps as turtle.circle().
+# Shapes are ('fill', rgb, pensize, points) or ('line', rgb, pensize,
+# points) with points in pixel coordinates (y axis going down).
+class RecordingTurtle(object):
+    def __init__(self):
+        self.shapes = []
+        self.x = 0.0
+        self.y = 0.0
+        self.heading = 0.0
+        self.down = True
+        self.size = 1
+        self.pen_rgb = (0, 0, 0)
+        self.fill_rgb = (0, 0, 0)
+        self.fill_path = None
+        self.fill_index = 0
+        self.line = None
+
+    def penup(self):
+        self.down = False
+        self.line = None
+
+    def pendown(self):
+        self.down = True
+
+    def isdown(self):
+        return self.down
+
+    def pensize(self, width=None):
+        if width is None:
+            return self.size
+        self.size = width
+        self.line = None
+
+    def color(self, *args):
+        if len(args) == 1:
+            self.pen_rgb = self.fill_rgb = color_rgb(args[0])
+        elif len(args) == 2:
+            self.pen_rgb = color_rgb(args[0])
+            self.fill_rgb = color_rgb(args[1])
+        self.line = None
+
+    def setheading(self, angle):
+        self.heading = angle
+
+    def right(self, angle):
+        self.heading -= angle
+
+    def left(self, angle):
+        self.heading += angle
+
+    def goto(self, x, y=None):
+        if y is None:
+            x, y = x
+        if self.down:
+            if self.line is None:
+                self.line = [(self.x, -self.y)]
+                self.shapes.append(('line', self.pen_rgb, self.size,
+                                    self.line))
+            self.line.append((x, -y))
+        self.x = x
+        self.y = y
+        if self.fill_path is not None:
+            self.fill_path.append((x, -y))
+
+    def forward(self, distance):
+        angle = math.radians(self.heading)
+        self.goto(self.x + distance * math.cos(angle),
+                  self.y + distance * math.sin(angle))
+
+    def circle(self, radius):
+        # Same polygon as turtle.circle(radius)
+        steps = 1 + int(min(11 + abs(radius) / 6.0, 59.0))
+        w = 360.0 / steps
+        w2 = 0.5 * w
+        l = 2.0 * radius * math.sin(math.radians(w2))
+        self.left(w2)
+        for _ in range(steps):
+            self.forward(l)
+            self.left(w)
+        self.left(-w2)
+
+    def begin_fill(self):
+        self.fill_path = [(self.x, -self.y)]
+        self.fill_index = len(self.shapes)
+
+    def end_fill(self):
+        if self.fill_path is not None and len(self.fill_path) > 2:
+            # Like turtle, the fill goes under the lines drawn since
+            # begin_fill()
+            self.shapes.insert(self.fill_index, ('fill', self.fill_rgb,
+                                                 self.size, self.fill_path))
+        self.fill_path = None
+
+    # Batch of filled polygons, same shapes as drawing them one by one
+    # from their first point
+    def polygons_filled(self, polygons):
+        shapes = self.shapes
+        fill_rgb = self.fill_rgb
+        pen_rgb = self.pen_rgb
+        size = self.size
+        for poly in polygons:
+            points = [(x, -y) for x, y in poly]
+            shapes.append(('fill', fill_rgb, size, points))
+            shapes.append(('line', pen_rgb, size, points))
+        if polygons:
+            self.x, self.y = polygons[-1][-1]
+        self.line = None
+
+    # Text is not rendered headless
+    def write(self, *args, **kwargs):
+        pass
+
+    def clear(self):
+        self.shapes = []
+        self.line = None
+
+    def speed(self, *args):
+        pass
+
+    def hideturtle(self):
+        pass
+
+    def showturtle(self):
+        pass
+
+# Draw a flag with a recording turtle and return its shapes, the flag
+# top left corner is the pixel (0, 0)
+def record_flag(flag, width, height):
+    recorder = RecordingTurtle()
+    flag.draw(0, 0, width, height, RenderContext(recorder))
+    return recorder.shapes
+
+class Raster(object):
+    def __init__(self, width, height, pixels=None):
+        self.width = width
+        self.height = height
+        if pixels is None:
+            pixels = bytearray(bytes(RASTER_BACKGROUND) * (width * height))
+        self.pixels = pixels  # RGB, 3 bytes per pixel, rows top to bottom
+
+    def get_pixel(self, x, y):
+        i = (y * self.width + x) * 3
+        return tuple(self.pixels[i:i + 3])
+
+# "color" is a tuple of bytes values: RGB for a Raster or a palette index
+# for a PaletteRaster
+def fill_polygon(raster, points, color, left=0, top=0):
+    # Non-zero winding scanline fill, a pixel is filled if its center is
+    # inside, so the stars (self-intersecting paths) are filled entirely
+    edges = []
+    n = len(points)
+    for i in range(n):
+        x0, y0 = points[i]
+        x1, y1 = points[(i + 1) % n]
+        if y0 == y1:
+            continue
+        direction = 1
+        if y0 > y1:
+            x0, y0, x1, y1 = x1, y1, x0, y0
+            direction = -1
+        edges.append((y0, y1, x0, (x1 - x0) / (y1 - y0), direction))
+    if not edges:
+        return
+    ys = [p[1] for p in points]
+    row_start = max(top, int(math.floor(min(ys))))
+    row_end = min(top + raster.height, int(math.ceil(max(ys))))
+    color = bytes(color)
+    depth = len(color)
+    pixels = raster.pixels
+    for row in range(row_start, row_end):
+        yc = row + 0.5
+        crossings = sorted((x0 + (yc - y0) * dxdy, direction)
+                           for y0, y1, x0, dxdy, direction in edges
+                           if y0 <= yc < y1)
+        winding = 0
+        for x, direction in crossings:
+            if winding == 0:
+                x_start = x
+            winding += direction
+            if winding == 0:
+                a = max(left, int(math.ceil(x_start - 0.5)))
+                b = min(left + raster.width, int(math.ceil(x - 0.5)))
+                if a < b:
+                    i = ((row - top) * raster.width + (a - left)) * depth
+                    pixels[i:i + (b - a) * depth] = color * (b - a)
+
+def draw_line(raster, points, color, size=1, left=0, top=0):
+    color = bytes(color)
+    depth = len(color)
+    pixels = raster.pixels
+    half = (size - 1) // 2
+    for (x0, y0), (x1, y1) in zip(points, points[1:]):
+        steps = max(1, int(math.ceil(max(abs(x1 - x0), abs(y1 - y0)))))
+        # Clip the segment to the raster (plus the pen size), a poster
+        # tile only walks the part of a long strip border it contains
+        lo, hi = 0.0, 1.0
+        for p0, d, low, high in ((x0, x1 - x0, left - size,
+                                  left + raster.width + size),
+                                 (y0, y1 - y0, top - size,
+                                  top + raster.height + size)):
+            if d == 0:
+                if p0 < low or p0 > high:
+                    lo, hi = 1.0, 0.0
+            else:
+                ta, tb = sorted(((low - p0) / d, (high - p0) / d))
+                lo, hi = max(lo, ta), min(hi, tb)
+        if lo > hi:
+            continue
+        for s in range(int(math.floor(lo * steps)),
+                       min(steps, int(math.ceil(hi * steps))) + 1):
+            px = int(math.floor(x0 + (x1 - x0) * s / steps)) - left - half
+            py = int(math.floor(y0 + (y1 - y0) * s / steps)) - top - half
+            for yy in range(max(0, py), min(raster.height, py + size)):
+                a = max(0, px)
+                b = min(raster.width, px + size)
+                if a < b:
+                    i = (yy * raster.width + a) * depth
+                    pixels[i:i + (b - a) * depth] = color * (b - a)
+
+# Rasterize recorded shapes, (left, top) is the raster position inside the
+# full picture so only a part (tile) of a big flag can be rendered
+def rasterize(shapes, width, height, left=0, top=0):
+    raster = Raster(width, height)
+    for kind, rgb, size, points in shapes:
+        if kind == 'fill':
+            fill_polygon(raster, points, rgb, left, top)
+        else:
+            draw_line(raster, points, rgb, size, left, top)
+    return raster
+
+# Flags use a handful of colors, so a cached flag is kept as palette
+# indices (1 byte per pixel instead of 3) and its rows run-length encoded:
+# a row is a sequence of (index, run length) pairs (3 bytes each) and the
+# identical rows (all the rows of a strip) share the same bytes object.
+# It is expanded to RGB only when displayed or compared (to_rgb()).
+class PaletteRaster(object):
+    def __init__(self, width, height, palette, rows):
+        self.width = width
+        self.height = height
+        self.palette = palette  # list of RGB tuples
+        self.rows = rows        # run-length encoded rows
+
+    @classmethod
+    def from_indices(cls, width, height, palette, indices):
+        rows = []
+        shared = dict()
+        for y in range(height):
+            row = indices[y * width:(y + 1) * width]
+            runs = bytearray()
+            x = 0
+            while x < width:
+                index = row[x]
+                end = x + 1
+                while end < width and row[end] == index:
+                    end += 1
+                runs += struct.pack('>BH', index, end - x)
+                x = end
+            runs = bytes(runs)
+            rows.append(shared.setdefault(runs, runs))
+        return cls(width, height, palette, rows)
+
+    def row_runs(self, y):
+        row = self.rows[y]
+        for i in range(0, len(row), 3):
+            yield struct.unpack_from('>BH', row, i)
+
+    def row_indices(self, y):
+        return b''.join(bytes((index,)) * n for index, n in self.row_runs(y))
+
+    def get_pixel(self, x, y):
+        for index, n in self.row_runs(y):
+            if x < n:
+                return self.palette[index]
+            x -= n
+
+    def to_rgb(self):
+        colors = [bytes(rgb) for rgb in self.palette]
+        expanded = dict()  # Shared rows are expanded once
+        pixels = bytearray()
+        for y in range(self.height):
+            row = self.rows[y]
+            line = expanded.get(id(row))
+            if line is None:
+                line = expanded[id(row)] = b''.join(
+                    colors[index] * n for index, n in self.row_runs(y))
+            pixels += line
+        return Raster(self.width, self.height, pixels)
+
+    # Memory used by the pixels (the shared rows counted once)
+    def nbytes(self):
+        return (3 * len(self.palette)
+                + sum(len(row) for row in {id(r): r for r in self.rows}.values()))
+
+# Palette of recorded shapes, the background is the index 0. Returns the
+# palette (list of RGB) and the RGB -> index dictionary
+def shapes_palette(shapes):
+    palette = [RASTER_BACKGROUND]
+    indices = {RASTER_BACKGROUND: 0}
+    for _, rgb, _, _ in shapes:
+        if rgb not in indices:
+            indices[rgb] = len(palette)
+            palette.append(rgb)
+    if len(palette) > 256:
+        raise ValueError('Too many colors for a palette raster')
+    return palette, indices
+
+def rasterize_palette(shapes, width, height, left=0, top=0):
+    palette, indices = shapes_palette(shapes)
+    raster = Raster(width, height, bytearray(width * height))
+    for kind, rgb, size, points in shapes:
+        if kind == 'fill':
+            fill_polygon(raster, points, (indices[rgb],), left, top)
+        else:
+            draw_line(raster, points, (indices[rgb],), size, left, top)
+    return PaletteRaster.from_indices(width, height, palette, raster.pixels)
+
+# ratio False: stretched to FLAG_DEFAULT_RATIO, like in the gallery
+def render_flag_palette(flag, width, ratio=True):
+    height = int(round(width * (flag.ratio if ratio else FLAG_DEFAULT_RATIO)))
+    return rasterize_palette(record_flag(flag, width, height), width, height)
+
+RASTER_CACHE_SIZE = 256  # the whole catalog at a few sizes
+# (country code, width, ratio) -> PaletteRaster, least recently used first
+_raster_cache = dict()
+
+# For a process drawing the same flags again and again (not for one shot
+# pool workers), at most RASTER_CACHE_SIZE flags are kept
+def cached_flag_raster(flag, width, ratio=True):
+    key = (flag.country_code, width, ratio)
+    raster = _raster_cache.pop(key, None)
+    if raster is None:
+        raster = render_flag_palette(flag, width, ratio)
+        if len(_raster_cache) >= RASTER_CACHE_SIZE:
+            del _raster_cache[next(iter(_raster_cache))]
+    _raster_cache[key] = raster
+    return raster
+
+def find_flag(name):
+    for flag in flags_dict.values():
+        func_name = flag.drawing_func.__name__
+        if name in (flag.country_code, func_name, func_name[len('flag_'):]):
+            return flag
+    raise ValueError('Unknown flag: ' + name)
+
+def render_flag(flag, width, ratio=True):
+    height = int(round(width * (flag.ratio if ratio else FLAG_DEFAULT_RATIO)))
+    return rasterize(record_flag(flag, width, height), width, height)
+
+
+### POSTER RENDERING ###
+
+# Banners (20000 px wide and more) are rendered tile by tile: the flag
+# geometry is recorded once, then worker processes rasterize each tile
+# (shapes clipped to the tile bounds) and copy it straight into the
+# output PPM file mapped in memory with mmap. Peak memory is a few tiles,
+# not the whole picture, and the work scales with the cores.
+
+POSTER_TILE = 1024
+
+_poster = None  # Worker state: (mmap, shapes, width, header size)
+
+def _poster_init(path, shapes, width, header_size):
+    global _poster
+    f = open(path, 'r+b')
+    _poster = (mmap.mmap(f.fileno(), 0), shapes, width, header_size)
+    f.close()  # The mapping stays valid
+
+def _poster_tile(tile):
+    mm, shapes, width, header_size = _poster
+    left, top, w, h = tile
+    raster = rasterize(shapes, w, h, left, top)
+    stride = w * 3
+    for row in range(h):
+        offset = header_size + ((top + row) * width + left) * 3
+        mm[offset:offset + stride] = raster.pixels[row * stride:
+                                                   (row + 1) * stride]
+    mm.flush()
+    return tile
+
+def poster_tiles(width, height, tile=POSTER_TILE):
+    return [(left, top, min(tile, width - left), min(tile, height - top))
+            for top in range(0, height, tile)
+            for left in range(0, width, tile)]
+
+# Render a flag "width" pixels wide (respecting its ratio) into a binary
+# PPM file, returns the picture size
+def render_poster(flag, width, path, tile=POSTER_TILE, processes=None):
+    height = int(round(width * flag.ratio))
+    shapes = record_flag(flag, width, height)
+    header = b'P6\n%d %d\n255\n' % (width, height)
+    with open(path, 'wb') as f:
+        f.write(header)
+        f.truncate(len(header) + width * height * 3)
+    with multiprocessing.Pool(processes, _poster_init,
+                              (path, shapes, width, len(header))) as pool:
+        for _ in pool.imap_unordered(_poster_tile,
+                                     poster_tiles(width, height, tile)):
+            pass
+    return width, height
+
+
+### FLAG ATLAS ###
+
+# All the flags prerendered at ATLAS_SIZES widths, with their ratio and
+# with FLAG_DEFAULT_RATIO (the gallery layout), in one binary file opened
+# with mmap, so the gallery does not redraw every thumbnail with the turtle
+# at each startup. Layout (big endian):
+#   header: magic, version, fingerprint (sha256), entries count
+#   index:  one fixed size entry per thumbnail (country code, width,
+#           height, ratio, offset and size of the PPM blob, PPM header size)
+#   data:   PPM blobs (header + RGB pixels), usable as is by Tk
+# The fingerprint is computed from the recorded geometry of every flag, a
+# change in a flag definition or in a drawing helper rebuilds the atlas.
+
+ATLAS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'flags_atlas.bin')
+ATLAS_SIZES = (64, 120, 160)
+ATLAS_MAGIC = b'FLAGATLS'
+ATLAS_VERSION = 2
+ATLAS_HEADER = struct.Struct('>8sI32sI')
+ATLAS_ENTRY = struct.Struct('>4sHHdQII')
+
+def flags_fingerprint():
+    h = hashlib.sha256(repr((ATLAS_SIZES, FLAG_DEFAULT_RATIO)).encode())
+    for flag in flags_dict.values():
+        h.update(repr((flag.country_code, flag.ratio)).encode())
+        h.update(repr(record_flag(flag, 1000, round(1000 * flag.ratio)))
+                 .encode())
+    return h.digest()
+
+def build_atlas(path=ATLAS_FILE, processes=None):
+    jobs = [(flag.drawing_func.__name__, width, ratio)
+            for flag in flags_dict.values() for width in ATLAS_SIZES
+            for ratio in ((True, False) if flag.ratio != FLAG_DEFAULT_RATIO
+                          else (True,))]
+    with multiprocessing.Pool(processes) as pool:
+        rasters = pool.map(_palette_job, jobs)
+    index = []
+    blobs = []
+    offset = ATLAS_HEADER.size + ATLAS_ENTRY.size * len(jobs)
+    for (flag_func_name, width, _), raster in zip(jobs, rasters):
+        raster = raster.to_rgb()
+        flag = flags_dict[globals()[flag_func_name]]
+        ppm_header = b'P6\n%d %d\n255\n' % (raster.width, raster.height)
+        blob = ppm_header + bytes(raster.pixels)
+        index.append(ATLAS_ENTRY.pack(flag.country_code.encode(),
+                                      raster.width, raster.height,
+                                      flag.ratio, offset, len(blob),
+                                      len(ppm_header)))
+        blobs.append(blob)
+        offset += len(blob)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(ATLAS_HEADER.pack(ATLAS_MAGIC, ATLAS_VERSION,
+                                  flags_fingerprint(), len(jobs)))
+        f.writelines(index)
+        f.writelines(blobs)
+    os.replace(tmp, path)
+
+# Raises ValueError if the file is not an atlas of this version, is empty
+# or truncated
+class FlagAtlas(object):
+    def __init__(self, path=ATLAS_FILE):
+        with open(path, 'rb') as f:
+            # ValueError for an empty file
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mm)
+        try:
+            self._read_index(path)
+        except (ValueError, struct.error) as e:
+            self.close()
+            raise ValueError('%s: not a flag atlas (%s)' % (path, e))
+
+    def _read_index(self, path):
+        magic, version, self.fingerprint, count = \
+            ATLAS_HEADER.unpack_from(self.mm, 0)
+        if magic != ATLAS_MAGIC or version != ATLAS_VERSION:
+            raise ValueError('magic or version %d' % version)
+        # (country code, width, height) -> (ratio, offset, size, ppm header)
+        self.entries = dict()
+        for i in range(count):
+            code, width, height, ratio, offset, size, ppm_header = \
+                ATLAS_ENTRY.unpack_from(self.mm, ATLAS_HEADER.size
+                                        + i * ATLAS_ENTRY.size)
+            if offset + size > len(self.mm):
+                raise ValueError('truncated')
+            self.entries[(code.rstrip(b'\0').decode(), width, height)] = (
+                ratio, offset, size, ppm_header)
+
+    def close(self):
+        self.view.release()
+        self.mm.close()
+
+    # ratio False: the FLAG_DEFAULT_RATIO thumbnail
+    def _entry(self, flag, width, ratio):
+        height = int(round(width * (flag.ratio if ratio
+                                    else FLAG_DEFAULT_RATIO)))
+        return height, self.entries[(flag.country_code, width, height)]
+
+    # Zero-copy views on the mapped file, only the pages of the read
+    # thumbnails are loaded
+    def ppm(self, flag, width, ratio=True):
+        _, (_, offset, size, _) = self._entry(flag, width, ratio)
+        return self.view[offset:offset + size]
+
+    def raster(self, flag, width, ratio=True):
+        height, (_, offset, size, ppm_header) = \
+            self._entry(flag, width, ratio)
+        return Raster(width, height,
+                      self.view[offset + ppm_header:offset + size])
+
+    def photo_image(self, flag, width, ratio=True):
+        # Tk wants the PPM data base64 encoded, the only copy
+        ppm = self.ppm(flag, width, ratio)
+        return tkinter.PhotoImage(data=base64.b64encode(ppm), format='ppm')
+
+# Open the atlas, (re)building it if missing, unreadable (other version,
+# empty or truncated file) or stale
+def open_atlas(path=ATLAS_FILE):
+    if os.path.exists(path):
+        try:
+            atlas = FlagAtlas(path)
+        except ValueError:
+            atlas = None
+        if atlas is not None:
+            if atlas.fingerprint == flags_fingerprint():
+                return atlas
+            atlas.close()
+    build_atlas(path)
+    return FlagAtlas(path)
+
+# (canvas, item, image), Tk deletes the images without a Python reference
+_gallery_images = []
+
+# ct.clear() does not remove the images put directly on the canvas
+def clear_atlas_gallery():
+    for canvas, item, _ in _gallery_images:
+        canvas.delete(item)
+    del _gallery_images[:]
+
+# Same gallery as draw_all_flags() but the visible thumbnails are read from
+# the atlas (opened once by the caller) instead of drawn with the turtle.
+# Thumbnails are Tk images at their size: off-screen or scaled contexts
+# draw the flags.
+def draw_all_flags_atlas(width, border, atlas, ratio=False, ctx=None):
+    ctx = get_context(ctx)
+    target_screen = ctx.screen()
+    if width not in ATLAS_SIZES or target_screen is None or ctx.scale != 1:
+        return draw_all_flags(width, border, ratio=ratio, ctx=ctx)
+    window_width, window_height = ctx.window_size()
+    layout = gallery_layout(width, border, ratio, window_width, window_height)
+    canvas = target_screen.getcanvas()
+    clear_atlas_gallery()
+    for flag, x, y, w, h in layout:
+        sx, sy = x + ctx.dx, y + ctx.dy
+        if sy - h > window_height / 2 or sy < -window_height / 2:
+            continue  # Not visible
+        image = atlas.photo_image(flag, width, ratio)
+        # Turtle (x, y) is canvas (x, -y)
+        item = canvas.create_image(sx, -sy, image=image, anchor='nw')
+        _gallery_images.append((canvas, item, image))
+        ctx.color(FLAG_BORDER_COL)
+        rectangle(x, y, w, h, ctx=ctx)
+        ctx.penup()
+        ctx.goto(x + w / 2, y)
+        ctx.write(country_name(flag.country_code), align="center",
+                  font=("Arial", 11, "normal"))
+    return layout
+
+
+### DRAWING ANIMATIONS ###
+
+# "Flag being drawn" animations: the recorded shapes are replayed in the
+# drawing order on a single palette index buffer, each frame only draws
+# its new shapes (the delta) on the previous one. Frames are produced by a
+# generator and streamed to a writer, the GIF writer only encodes the
+# changed rectangle of each frame, so one frame is in memory at a time.
+
+ANIMATION_DELAY = 4           # hundredths of second between GIF frames
+ANIMATION_END_DELAY = 200     # last frame
+ANIMATION_MEMORY_BUDGET = 256 * 1024 * 1024  # for all the export workers
+
+def _shape_bbox(points, size, width, height):
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    x0 = max(0, int(math.floor(min(xs))) - size)
+    y0 = max(0, int(math.floor(min(ys))) - size)
+    x1 = min(width, int(math.ceil(max(xs))) + size + 1)
+    y1 = min(height, int(math.ceil(max(ys))) + size + 1)
+    return x0, y0, x1, y1
+
+# Yields (buffer, bbox) where buffer is the Raster of palette indices
+# (updated in place, use it before asking the next frame) and bbox the
+# (x0, y0, x1, y1) changed rectangle. The first frame is the background.
+def animation_frames(shapes, palette_indices, width, height,
+                     steps_per_frame=1):
+    buffer = Raster(width, height, bytearray(width * height))
+    yield buffer, (0, 0, width, height)
+    bbox = None
+    for step, (kind, rgb, size, points) in enumerate(shapes, 1):
+        color = (palette_indices[rgb],)
+        if kind == 'fill':
+            fill_polygon(buffer, points, color)
+        else:
+            draw_line(buffer, points, color, size)
+        x0, y0, x1, y1 = _shape_bbox(points, size, width, height)
+        if bbox is not None:
+            x0, y0 = min(x0, bbox[0]), min(y0, bbox[1])
+            x1, y1 = max(x1, bbox[2]), max(y1, bbox[3])
+        bbox = (x0, y0, x1, y1)
+        if step % steps_per_frame == 0 or step == len(shapes):
+            if x0 < x1 and y0 < y1:
+                yield buffer, bbox
+            bbox = None
+
+def _gif_lzw(data, min_code_size):
+    clear = 1 << min_code_size
+    end = clear + 1
+    out = bytearray()
+    bits = 0
+    nbits = 0
+    code_size = min_code_size + 1
+    table = dict()
+    next_code = end + 1
+    prefix = None
+    # Codes are packed least significant bits first
+    def emit(code, size):
+        nonlocal bits, nbits
+        bits |= code << nbits
+        nbits += size
+        while nbits >= 8:
+            out.append(bits & 0xFF)
+            bits >>= 8
+            nbits -= 8
+    emit(clear, code_size)
+    for k in data:
+        if prefix is None:
+            prefix = k
+            continue
+        code = table.get((prefix, k))
+        if code is not None:
+            prefix = code
+            continue
+        emit(prefix, code_size)
+        table[(prefix, k)] = next_code
+        next_code += 1
+        if next_code > (1 << code_size) and code_size < 12:
+            code_size += 1
+        if next_code == 4096:
+            emit(clear, code_size)
+            table = dict()
+            next_code = end + 1
+            code_size = min_code_size + 1
+        prefix = k
+    if prefix is not None:
+        emit(prefix, code_size)
+    emit(end, code_size)
+    if nbits:
+        out.append(bits & 0xFF)
+    return out
+
+# Animated GIF written frame by frame, every frame only covers its
+# changed rectangle and is kept (disposal "do not dispose")
+class GifWriter(object):
+    def __init__(self, path, width, height, palette, delay=ANIMATION_DELAY):
+        self.width = width
+        self.height = height
+        self.delay = delay
+        self.pending = None  # Last frame, written with its delay later
+        bits = max(1, (len(palette) - 1).bit_length())
+        self.min_code_size = max(2, bits)
+        table = b''.join(bytes(c) for c in palette)
+        table += b'\0' * (3 * (1 << bits) - len(table))
+        self.f = open(path, 'wb')
+        self.f.write(b'GIF89a' + struct.pack('<HHBBB', width, height,
+                                             0x80 | (bits - 1), 0, 0) + table)
+        # Loop forever
+        self.f.write(b'\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00')
+
+    def _write_frame(self, frame, delay):
+        (x0, y0, x1, y1), data = frame
+        self.f.write(struct.pack('<BBBBHBB', 0x21, 0xF9, 4, 1 << 2,
+                                 delay, 0, 0))
+        self.f.write(struct.pack('<BHHHHB', 0x2C, x0, y0, x1 - x0, y1 - y0, 0))
+        self.f.write(bytes((self.min_code_size,)))
+        data = _gif_lzw(data, self.min_code_size)
+        for i in range(0, len(data), 255):
+            block = data[i:i + 255]
+            self.f.write(bytes((len(block),)) + block)
+        self.f.write(b'\0')
+
+    def add_frame(self, buffer, bbox):
+        x0, y0, x1, y1 = bbox
+        data = b''.join(buffer.pixels[y * self.width + x0:y * self.width + x1]
+                        for y in range(y0, y1))
+        if self.pending is not None:
+            self._write_frame(self.pending, self.delay)
+        self.pending = (bbox, data)
+
+    def close(self):
+        if self.pending is not None:
+            self._write_frame(self.pending, ANIMATION_END_DELAY)
+        self.f.write(b'\x3b')
+        self.f.close()
+
+# One indexed PNG file per frame: <prefix>_0000.png, <prefix>_0001.png...
+class PngSequenceWriter(object):
+    def __init__(self, prefix, width, height, palette):
+        self.prefix = prefix
+        self.width = width
+        self.height = height
+        self.palette = palette
+        self.count = 0
+
+    def add_frame(self, buffer, bbox):
+        write_png(PaletteRaster.from_indices(self.width, self.height,
+                                             self.palette, buffer.pixels),
+                  '%s_%04d.png' % (self.prefix, self.count))
+        self.count += 1
+
+    def close(self):
+        pass
+
+# Export the drawing animation of a flag "width" pixels wide, "path" is
+# the GIF file or, for the PNG sequence, the files prefix
+def export_animation(flag, width, path, fmt='gif', steps_per_frame=1):
+    height = int(round(width * flag.ratio))
+    shapes = record_flag(flag, width, height)
+    palette, indices = shapes_palette(shapes)
+    if fmt == 'gif':
+        writer = GifWriter(path, width, height, palette)
+    else:
+        writer = PngSequenceWriter(path, width, height, palette)
+    frames = 0
+    try:
+        for buffer, bbox in animation_frames(shapes, indices, width, height,
+                                             steps_per_frame):
+            writer.add_frame(buffer, bbox)
+            frames += 1
+    finally:
+        writer.close()
+    return frames
+
+def _animation_job(job):
+    flag_func_name, width, directory, fmt, steps_per_frame = job
+    path = os.path.join(directory, flag_func_name)
+    if fmt == 'gif':
+        path += '.gif'
+    return export_animation(flags_dict[globals()[flag_func_name]], width,
+                            path, fmt, steps_per_frame)
+
+# Export every flag in parallel, with not more workers than the memory
+# budget allows (a worker holds one frame and one changed rectangle)
+def export_all_animations(directory, width, fmt='gif', steps_per_frame=1,
+                          processes=None, memory_budget=ANIMATION_MEMORY_BUDGET):
+    os.makedirs(directory, exist_ok=True)
+    max_height = int(round(width * max(f.ratio for f in flags_dict.values())))
+    frame_bytes = width * max_height * 2 + 32 * 1024 * 1024  # + interpreter
+    processes = min(processes or os.cpu_count() or 1,
+                    max(1, memory_budget // frame_bytes))
+    jobs = [(flag.drawing_func.__name__, width, directory, fmt,
+             steps_per_frame) for flag in flags_dict.values()]
+    with multiprocessing.Pool(processes) as pool:
+        return sum(pool.imap_unordered(_animation_job, jobs))
+
+
+### WIRE FORMAT ###
+
+# Compact binary encoding of the flags geometry for thin clients, which
+# replay it at their own size instead of downloading PNGs. A flag is
+# recorded at the primitives level by a WireRecorder: filled polygons,
+# circles (kept as circles, the client tessellates them for its size like
+# turtle.circle()) and motif instances (shared motifs, see MOTIFS).
+# Coordinates are quantized on 16 bits: x and y (going down) in
+# WIRE_UNIT of the flag width and height, lengths (radius, motif scale) in
+# WIRE_UNIT of the width. WIRE_UNIT is a multiple of the usual fractions
+# of flags (halves, thirds... thirteenths) so strips edges stay exact.
+# Little endian layout of a flag:
+#   'FW', version (B), country code (3s), ratio (f), palette size (B),
+#   palette (RGB bytes), operations count (H), operations:
+#     POLYGON fill (B), pen (B), points count (H), points (HH)...
+#     CIRCLE  fill (B), pen (B), center (HH), radius (H)
+#     LINE    pen (B), points count (H), points (HH)...
+#     MOTIF   fill (B), pen (B), motif (B), count (H),
+#             (x, y, scale, rotation in 1/100 degree) (HHHh)...
+# fill/pen are palette indices, WIRE_NONE for no fill/outline.
+# A catalog is 'FWCT', flags count (H) then for each flag its size (I)
+# and its encoding, it can be streamed flag by flag.
+
+WIRE_VERSION = 1
+WIRE_UNIT = 32760  # 2**3 * 3**2 * 5 * 7 * 13
+WIRE_NONE = 255
+WIRE_POLYGON, WIRE_CIRCLE, WIRE_LINE, WIRE_MOTIF = 1, 2, 3, 4
+WIRE_HEADER = struct.Struct('<2sB3sfB')
+WIRE_POINT = struct.Struct('<HH')
+WIRE_INSTANCE = struct.Struct('<HHHh')
+MOTIFS = (STAR_MOTIF,)
+
+# Duck-typed turtle keeping the drawing at the primitives level
+# (operations are tuples, see encode_flag())
+class WireRecorder(object):
+    def __init__(self):
+        self.ops = []
+        self.x = 0.0
+        self.y = 0.0
+        self.heading = 0.0
+        self.down = True
+        self.pen_rgb = (0, 0, 0)
+        self.fill_rgb = (0, 0, 0)
+        self.fill = None  # [points, circles, outlined]
+        self.line = None
+
+    def penup(self):
+        self.down = False
+        self.line = None
+
+    def pendown(self):
+        self.down = True
+
+    def isdown(self):
+        return self.down
+
+    def pensize(self, width=None):
+        return 1  # The wire format is drawn with a 1 pixel pen
+
+    def color(self, *args):
+        if len(args) == 1:
+            self.pen_rgb = self.fill_rgb = color_rgb(args[0])
+        elif len(args) == 2:
+            self.pen_rgb = color_rgb(args[0])
+            self.fill_rgb = color_rgb(args[1])
+        self.line = None
+
+    def setheading(self, angle):
+        self.heading = angle
+
+    def right(self, angle):
+        self.heading -= angle
+
+    def left(self, angle):
+        self.heading += angle
+
+    def goto(self, x, y=None):
+        if y is None:
+            x, y = x
+        if self.fill is not None:
+            self.fill[0].append((x, -y))
+            self.fill[2] = self.fill[2] or self.down
+        elif self.down:
+            if self.line is None:
+                self.line = [(self.x, -self.y)]
+                self.ops.append(('line', self.pen_rgb, self.line))
+            self.line.append((x, -y))
+        self.x = x
+        self.y = y
+
+    def forward(self, distance):
+        angle = math.radians(self.heading)
+        self.goto(self.x + distance * math.cos(angle),
+                  self.y + distance * math.sin(angle))
+
+    # A full circle ends where it started, only its center is kept
+    def circle(self, radius):
+        angle = math.radians(self.heading)
+        center = (self.x - radius * math.sin(angle),
+                  -(self.y + radius * math.cos(angle)))
+        if self.fill is not None:
+            self.fill[1].append((center, radius))
+            self.fill[2] = self.fill[2] or self.down
+        elif self.down:
+            self.ops.append(('circle', None, self.pen_rgb, center, radius))
+        self.line = None
+
+    def begin_fill(self):
+        self.fill = [[(self.x, -self.y)], [], False]
+
+    def end_fill(self):
+        points, circles, outlined = self.fill
+        self.fill = None
+        pen = self.pen_rgb if outlined else None
+        if len(circles) == 1 and len(points) <= 2:
+            center, radius = circles[0]
+            self.ops.append(('circle', self.fill_rgb, pen, center, radius))
+            return
+        # The fill starts where the turtle was before moving to the shape
+        # (which ends where it started, up to the turtle rounding errors)
+        if len(points) > 2 and (abs(points[1][0] - points[-1][0]) < 0.5
+                                and abs(points[1][1] - points[-1][1]) < 0.5):
+            points = points[1:]
+        if len(points) > 2:
+            self.ops.append(('polygon', self.fill_rgb, pen, points))
+
+    def motif_filled(self, motif, transforms):
+        self.ops.append(('motif', self.fill_rgb, self.pen_rgb, motif,
+                         [(x, -y, k, r) for x, y, k, r in transforms]))
+
+    def write(self, *args, **kwargs):
+        pass
+
+    def clear(self):
+        self.ops = []
+
+    def speed(self, *args):
+        pass
+
+    def hideturtle(self):
+        pass
+
+    def showturtle(self):
+        pass
+
+def encode_flag(flag):
+    recorder = WireRecorder()
+    flag.draw(0, 0, WIRE_UNIT, WIRE_UNIT * flag.ratio,
+              RenderContext(recorder))
+    palette = []
+    def index(rgb):
+        if rgb is None:
+            return WIRE_NONE
+        if rgb not in palette:
+            palette.append(rgb)
+        return palette.index(rgb)
+    def q(v):
+        return max(0, min(65535, int(round(v))))
+    ry = 1 / flag.ratio  # y in WIRE_UNIT of the height
+    body = bytearray()
+    for op in recorder.ops:
+        if op[0] == 'polygon':
+            _, fill, pen, points = op
+            body += struct.pack('<BBBH', WIRE_POLYGON, index(fill),
+                                index(pen), len(points))
+            for x, y in points:
+                body += WIRE_POINT.pack(q(x), q(y * ry))
+        elif op[0] == 'circle':
+            _, fill, pen, (x, y), radius = op
+            body += struct.pack('<BBBHHH', WIRE_CIRCLE, index(fill),
+                                index(pen), q(x), q(y * ry), q(abs(radius)))
+        elif op[0] == 'line':
+            _, pen, points = op
+            body += struct.pack('<BBH', WIRE_LINE, index(pen), len(points))
+            for x, y in points:
+                body += WIRE_POINT.pack(q(x), q(y * ry))
+        else:
+            _, fill, pen, motif, transforms = op
+            body += struct.pack('<BBBBH', WIRE_MOTIF, index(fill), index(pen),
+                                MOTIFS.index(motif), len(transforms))
+            for x, y, k, r in transforms:
+                r = (r + 180) % 360 - 180
+                body += WIRE_INSTANCE.pack(q(x), q(y * ry), q(k),
+                                           int(round(r * 100)))
+    if len(palette) >= WIRE_NONE:
+        raise ValueError('Too many colors for the wire format')
+    return (WIRE_HEADER.pack(b'FW', WIRE_VERSION,
+                             flag.country_code.encode(), flag.ratio,
+                             len(palette))
+            + b''.join(bytes(c) for c in palette)
+            + struct.pack('<H', len(recorder.ops)) + body)
+
+# Header of an encoded flag: (country code, ratio)
+def wire_flag_info(data):
+    magic, version, code, ratio, _ = WIRE_HEADER.unpack_from(data, 0)
+    if magic != b'FW' or version != WIRE_VERSION:
+        raise ValueError('Not a wire flag')
+    return code.decode(), ratio
+
+# Draw an encoded flag (bytes, bytearray or memoryview, read in place)
+# with its top left corner at (x, y) and "width" wide, with the same
+# primitives as the flag functions. The height is width * ratio unless
+# given (e.g. rounded to pixels).
+def replay_flag(data, x, y, width, height=None, ctx=None):
+    ctx = get_context(ctx)
+    data = memoryview(data)
+    pos = WIRE_HEADER.size
+    _, _, _, ratio, ncolors = WIRE_HEADER.unpack_from(data, 0)
+    palette = ['#%02x%02x%02x' % tuple(data[pos + i * 3:pos + i * 3 + 3])
+               for i in range(ncolors)]
+    pos += ncolors * 3
+    (count,) = struct.unpack_from('<H', data, pos)
+    pos += 2
+    k = width / WIRE_UNIT
+    if height is None:
+        height = width * ratio
+    ky = height / WIRE_UNIT
+    def points(n):
+        nonlocal pos
+        pts = [(x + px * k, y - py * ky) for px, py in
+               WIRE_POINT.iter_unpack(data[pos:pos + n * WIRE_POINT.size])]
+        pos += n * WIRE_POINT.size
+        return pts
+    def set_color(fill, pen):
+        if pen == WIRE_NONE:
+            ctx.color(palette[fill])
+        elif fill == WIRE_NONE:
+            ctx.color(palette[pen])
+        else:
+            ctx.color(palette[pen], palette[fill])
+    for _ in range(count):
+        op = data[pos]
+        if op == WIRE_POLYGON:
+            fill, pen, n = struct.unpack_from('<BBH', data, pos + 1)
+            pos += 5
+            poly = points(n)
+            set_color(fill, pen)
+            ctx.penup()
+            ctx.goto(poly[0])
+            if pen != WIRE_NONE:
+                ctx.pendown()
+            ctx.begin_fill()
+            for point in poly[1:] + poly[:1]:
+                ctx.goto(point)
+            ctx.end_fill()
+        elif op == WIRE_CIRCLE:
+            fill, pen, cx, cy, radius = struct.unpack_from('<BBHHH', data,
+                                                           pos + 1)
+            pos += 9
+            set_color(fill, pen)
+            cx, cy, radius = x + cx * k, y - cy * ky, radius * k
+            ctx.penup()
+            ctx.goto(cx, cy - radius)
+            ctx.setheading(0)
+            if pen != WIRE_NONE:
+                ctx.pendown()
+            if fill != WIRE_NONE:
+                ctx.begin_fill()
+            ctx.circle(radius)
+            if fill != WIRE_NONE:
+                ctx.end_fill()
+        elif op == WIRE_LINE:
+            pen, n = struct.unpack_from('<BH', data, pos + 1)
+            pos += 4
+            line = points(n)
+            ctx.color(palette[pen])
+            ctx.penup()
+            ctx.goto(line[0])
+            ctx.pendown()
+            for point in line[1:]:
+                ctx.goto(point)
+        elif op == WIRE_MOTIF:
+            fill, pen, motif, n = struct.unpack_from('<BBBH', data, pos + 1)
+            pos += 6
+            set_color(fill, pen)
+            transforms = [(x + tx * k, y - ty * ky, scale * k, r / 100)
+                          for tx, ty, scale, r in WIRE_INSTANCE.iter_unpack(
+                              data[pos:pos + n * WIRE_INSTANCE.size])]
+            pos += n * WIRE_INSTANCE.size
+            motif_filled(MOTIFS[motif], transforms, ctx)
+        else:
+            raise ValueError('Bad wire operation %d' % op)
+
+# The whole catalog, chunk by chunk, for a streamed response
+def encode_catalog():
+    yield b'FWCT' + struct.pack('<H', len(flags_dict))
+    for flag in flags_dict.values():
+        data = encode_flag(flag)
+        yield struct.pack('<I', len(data)) + data
+
+# Encoded flags of a catalog, as memoryview slices of "data"
+def iter_catalog(data):
+    data = memoryview(data)
+    if bytes(data[:4]) != b'FWCT':
+        raise ValueError('Not a wire catalog')
+    (count,) = struct.unpack_from('<H', data, 4)
+    pos = 6
+    for _ in range(count):
+        (size,) = struct.unpack_from('<I', data, pos)
+        yield data[pos + 4:pos + 4 + size]
+        pos += 4 + size
+
+
+### IMAGE FILES ###
+
+def _png_unfilter(data, width, height, bpp):
+    stride = width * bpp
+    out = bytearray(stride * height)
+    prev = bytearray(stride)
+    pos = 0
+    for row in range(height):
+        ftype = data[pos]
+        line = bytearray(data[pos + 1:pos + 1 + stride])
+        pos += 1 + stride
+        if ftype == 1:
+            for i in range(bpp, stride):
+                line[i] = (line[i] + line[i - bpp]) & 0xFF
+        elif ftype == 2:
+            for i in range(stride):
+                line[i] = (line[i] + prev[i]) & 0xFF
+        elif ftype == 3:
+            for i in range(stride):
+                a = line[i - bpp] if i >= bpp else 0
+                line[i] = (line[i] + ((a + prev[i]) >> 1)) & 0xFF
+        elif ftype == 4:
+            for i in range(stride):
+                a = line[i - bpp] if i >= bpp else 0
+                b = prev[i]
+                c = prev[i - bpp] if i >= bpp else 0
+                p = a + b - c
+                pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+                if pa <= pb and pa <= pc:
+                    pred = a
+                elif pb <= pc:
+                    pred = b
+                else:
+                    pred = c
+                line[i] = (line[i] + pred) & 0xFF
+        elif ftype != 0:
+            raise ValueError('Bad PNG filter type %d' % ftype)
+        out[row * stride:(row + 1) * stride] = line
+        prev = line
+    return out
+
+# 8 bits per channel, non-interlaced PNG (gray, RGB, palette, with or
+# without alpha), alpha is blended over the raster background
+def read_png(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:8] != b'\x89PNG\r\n\x1a\n':
+        raise ValueError(path + ': not a PNG file')
+    pos = 8
+    idat = []
+    palette = None
+    while pos < len(data):
+        length, ctype = struct.unpack('>I4s', data[pos:pos + 8])
+        chunk = data[pos + 8:pos + 8 + length]
+        pos += 12 + length
+        if ctype == b'IHDR':
+            width, height, depth, color_type, _, _, interlace = \
+                struct.unpack('>IIBBBBB', chunk)
+        elif ctype == b'PLTE':
+            palette = chunk
+        elif ctype == b'IDAT':
+            idat.append(chunk)
+        elif ctype == b'IEND':
+            break
+    if depth != 8 or interlace:
+        raise ValueError(path + ': only 8 bits non-interlaced PNG supported')
+    bpp = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}[color_type]
+    raw = _png_unfilter(zlib.decompress(b''.join(idat)), width, height, bpp)
+    if color_type == 2:
+        return Raster(width, height, raw)
+    if color_type == 3:
+        pixels = bytearray()
+        for i in raw:
+            pixels += palette[i * 3:i * 3 + 3]
+        return Raster(width, height, pixels)
+    pixels = bytearray(width * height * 3)
+    bg = RASTER_BACKGROUND
+    for i in range(width * height):
+        if color_type == 0:
+            pixels[i * 3:i * 3 + 3] = bytes((raw[i],)) * 3
+            continue
+        if color_type == 4:
+            rgb = (raw[i * 2],) * 3
+            alpha = raw[i * 2 + 1]
+        else:
+            rgb = raw[i * 4:i * 4 + 3]
+            alpha = raw[i * 4 + 3]
+        pixels[i * 3:i * 3 + 3] = bytes(
+            (c * alpha + b * (255 - alpha)) // 255 for c, b in zip(rgb, bg))
+    return Raster(width, height, pixels)
+
+# 8 bits PNG, RGB for a Raster, indexed colors for a PaletteRaster
+def write_png(raster, path):
+    raw = bytearray()
+    if isinstance(raster, PaletteRaster):
+        color_type = 3
+        for row in range(raster.height):
+            raw.append(0)  # No filter, flags are flat colors zlib does well
+            raw += raster.row_indices(row)
+    else:
+        color_type = 2
+        stride = raster.width * 3
+        for row in range(raster.height):
+            raw.append(0)
+            raw += raster.pixels[row * stride:(row + 1) * stride]
+    def chunk(ctype, data):
+        return (struct.pack('>I', len(data)) + ctype + data
+                + struct.pack('>I', zlib.crc32(ctype + data) & 0xFFFFFFFF))
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', raster.width,
+                                           raster.height, 8, color_type,
+                                           0, 0, 0)))
+        if color_type == 3:
+            f.write(chunk(b'PLTE', b''.join(bytes(c) for c in raster.palette)))
+        f.write(chunk(b'IDAT', zlib.compress(bytes(raw), 9)))
+        f.write(chunk(b'IEND', b''))
+
+# Binary (P6) PPM
+def read_ppm(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    fields = []
+    pos = 2
+    while len(fields) < 3:
+        while data[pos:pos + 1].isspace():
+            pos += 1
+        if data[pos:pos + 1] == b'#':
+            pos = data.index(b'\n', pos)
+            continue
+        end = pos
+        while not data[end:end + 1].isspace():
+            end += 1
+        fields.append(int(data[pos:end]))
+        pos = end
+    width, height, maxval = fields
+    if maxval != 255:
+        raise ValueError(path + ': only 8 bits PPM supported')
+    pos += 1
+    return Raster(width, height, bytearray(data[pos:pos + width * height * 3]))
+
+def read_image(path):
+    with open(path, 'rb') as f:
+        magic = f.read(8)
+    if magic.startswith(b'\x89PNG'):
+        return read_png(path)
+    if magic.startswith(b'P6'):
+        return read_ppm(path)
+    raise ValueError(path + ': unsupported image format (PNG or PPM only)')
+
+
+### REVERSE LOOKUP ###
+
+# "What flag is this?": every flag is rendered once and described by
+#   - a 128 bits perceptual hash (difference hash on rows and columns of a
+#     9x8 / 8x9 gray thumbnail), robust to scaling and small shifts
+#   - a colour layout, the average colour of a 4x4 grid (48 bytes), as
+#     most flags share the same strips shapes and only differ by colours
+#   - the Flag.ratio
+# The distance is a weighted sum of metrics, so it is a metric and the
+# nearest flags are found with a vantage-point tree.
+
+FLAG_INDEX_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               'flags_index.json')
+FLAG_INDEX_WIDTH = 96   # width of the flags rendered to build the index
+LAYOUT_GRID = 4
+HASH_WEIGHT = 0.3
+LAYOUT_WEIGHT = 1.0
+RATIO_WEIGHT = 0.2
+
+# Average colour of each cell of a cols x rows grid, big images are
+# sampled (at most 4x4 pixels per cell) to keep queries fast
+def grid_colors(raster, cols, rows):
+    cells = []
+    for r in range(rows):
+        y0 = r * raster.height // rows
+        y1 = max(y0 + 1, (r + 1) * raster.height // rows)
+        ystep = max(1, (y1 - y0) // 4)
+        for c in range(cols):
+            x0 = c * raster.width // cols
+            x1 = max(x0 + 1, (c + 1) * raster.width // cols)
+            xstep = max(1, (x1 - x0) // 4)
+            tr = tg = tb = n = 0
+            for y in range(y0, y1, ystep):
+                i = y * raster.width * 3
+                for x in range(x0, x1, xstep):
+                    j = i + x * 3
+                    tr += raster.pixels[j]
+                    tg += raster.pixels[j + 1]
+                    tb += raster.pixels[j + 2]
+                    n += 1
+            cells.append((tr // n, tg // n, tb // n))
+    return cells
+
+def _gray(rgb):
+    return 0.299 * rgb[0] + 0.587 * rgb[1] + 0.114 * rgb[2]
+
+def perceptual_hash(raster):
+    bits = 0
+    g = [_gray(c) for c in grid_colors(raster, 9, 8)]
+    for r in range(8):
+        for c in range(8):
+            bits = (bits << 1) | (g[r * 9 + c] < g[r * 9 + c + 1])
+    g = [_gray(c) for c in grid_colors(raster, 8, 9)]
+    for r in range(8):
+        for c in range(8):
+            bits = (bits << 1) | (g[r * 8 + c] < g[(r + 1) * 8 + c])
+    return bits
+
+def color_layout(raster):
+    return bytes(v for cell in grid_colors(raster, LAYOUT_GRID, LAYOUT_GRID)
+                 for v in cell)
+
+def image_descriptor(raster):
+    return (perceptual_hash(raster), color_layout(raster),
+            raster.height / raster.width)
+
+def descriptor_distance(a, b):
+    hamming = bin(a[0] ^ b[0]).count('1') / 128
+    layout = sum(abs(x - y) for x, y in zip(a[1], b[1])) / (len(a[1]) * 255)
+    return (HASH_WEIGHT * hamming + LAYOUT_WEIGHT * layout
+            + RATIO_WEIGHT * abs(a[2] - b[2]))
+
+class VPNode(object):
+    def __init__(self, item, radius, inside, outside):
+        self.item = item
+        self.radius = radius
+        self.inside = inside
+        self.outside = outside
+
+def vp_tree(items):
+    # items are (descriptor, country_code)
+    if not items:
+        return None
+    vantage, rest = items[0], items[1:]
+    if not rest:
+        return VPNode(vantage, 0, None, None)
+    dists = [(descriptor_distance(vantage[0], it[0]), it) for it in rest]
+    dists.sort(key=lambda d: d[0])
+    median = dists[len(dists) // 2][0]
+    inside = [it for d, it in dists if d < median]
+    outside = [it for d, it in dists if d >= median]
+    return VPNode(vantage, median, vp_tree(inside), vp_tree(outside))
+
+class FlagIndex(object):
+    def __init__(self, entries):
+        # entries: list of (descriptor, country_code)
+        self.entries = entries
+        self.tree = vp_tree(list(entries))
+
+    @classmethod
+    def build(cls):
+        entries = []
+        for flag in flags_dict.values():
+            raster = render_flag(flag, FLAG_INDEX_WIDTH)
+            entries.append((image_descriptor(raster), flag.country_code))
+        return cls(entries)
+
+    def save(self, path=FLAG_INDEX_FILE):
+        data = [dict(country_code=code, hash='%032x' % d[0],
+                     layout=d[1].hex(), ratio=d[2])
+                for d, code in self.entries]
+        with open(path, 'w') as f:
+            json.dump(dict(width=FLAG_INDEX_WIDTH,
+                           fingerprint=flags_fingerprint().hex(),
+                           flags=data), f)
+
+    # check: None if the index does not match the flags drawing (see
+    # flags_fingerprint()) or FLAG_INDEX_WIDTH
+    @classmethod
+    def load(cls, path=FLAG_INDEX_FILE, check=False):
+        with open(path) as f:
+            data = json.load(f)
+        if check and (data.get('width') != FLAG_INDEX_WIDTH
+                      or data.get('fingerprint')
+                      != flags_fingerprint().hex()):
+            return None
+        return cls([((int(e['hash'], 16), bytes.fromhex(e['layout']),
+                      e['ratio']), e['country_code'])
+                    for e in data['flags']])
+
+    # k nearest flags, list of (country_code, distance)
+    def query(self, raster, k=3):
+        target = image_descriptor(raster)
+        best = []  # sorted (distance, country_code)
+        nodes = [self.tree]
+        while nodes:
+            node = nodes.pop()
+            if node is None:
+                continue
+            d = descriptor_distance(target, node.item[0])
+            if len(best) < k or d < best[-1][0]:
+                best.append((d, node.item[1]))
+                best.sort()
+                del best[k:]
+            tau = best[-1][0] if len(best) == k else float('inf')
+            if d < node.radius:
+                if d + tau >= node.radius:
+                    nodes.append(node.outside)
+                nodes.append(node.inside)
+            else:
+                if d - tau < node.radius:
+                    nodes.append(node.inside)
+                nodes.append(node.outside)
+        return [(code, d) for d, code in best]
+
+# Load the index built by "build-index", (re)build and save it if missing
+# or stale
+def load_flag_index(path=FLAG_INDEX_FILE):
+    if os.path.exists(path):
+        index = FlagIndex.load(path, check=True)
+        if index is not None:
+            return index
+    index = FlagIndex.build()
+    index.save(path)
+    return index
+
+_lookup_index = None
+
+def _lookup_init(index_path):
+    global _lookup_index
+    _lookup_index = FlagIndex.load(index_path)
+
+def _lookup_file(args):
+    path, k = args
+    return path, _lookup_index.query(read_image(path), k)
+
+# Query every PNG/PPM image of a directory, on all the cores by default
+def lookup_directory(directory, k=3, index_path=FLAG_INDEX_FILE,
+                     processes=None):
+    load_flag_index(index_path)  # Check it once, not in every worker
+    paths = sorted(os.path.join(directory, name)
+                   for name in os.listdir(directory)
+                   if name.lower().endswith(('.png', '.ppm')))
+    with multiprocessing.Pool(processes, _lookup_init, (index_path,)) as pool:
+        return pool.map(_lookup_file, [(p, k) for p in paths])
+
+
+### GOLDEN IMAGES REGRESSION ###
+
+# Every flag is rendered headlessly at GOLDEN_SIZES and compared with the
+# PNG stored in GOLDEN_DIR, so a change in a shared helper (strips,
+# crosses, stars...) shows which flags changed. A flag fails when too
+# many pixels differ by more than GOLDEN_TOLERANCE on a channel, or when
+# its perceptual distance (see REVERSE LOOKUP) is too large. Diff images
+# (differing pixels in red) are written to GOLDEN_DIFF_DIR.
+# Goldens are only changed by the explicit "update-golden" command.
+
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'golden')
+GOLDEN_DIFF_DIR = os.path.join(GOLDEN_DIR, 'diff')
+GOLDEN_SIZES = (64, 160)
+GOLDEN_TOLERANCE = 8        # per channel
+GOLDEN_MAX_PIXELS = 0.002   # fraction of pixels over the tolerance
+GOLDEN_MAX_DISTANCE = 0.01  # descriptor_distance()
+
+def golden_path(flag_func_name, width):
+    return os.path.join(GOLDEN_DIR, '%s_%d.png' % (flag_func_name, width))
+
+def golden_jobs():
+    return [(flag.drawing_func.__name__, width)
+            for flag in flags_dict.values() for width in GOLDEN_SIZES]
+
+def _render_job(job):
+    flag_func_name, width = job
+    return render_flag(flags_dict[globals()[flag_func_name]], width)
+
+def _palette_job(job):
+    flag_func_name, width, ratio = job
+    return render_flag_palette(flags_dict[globals()[flag_func_name]], width,
+                               ratio)
+
+# Goldens are indexed PNGs written from the palette rasterizer, checked
+# against both rasterizers
+def _update_golden(job):
+    write_png(_palette_job(job + (True,)), golden_path(*job))
+    return job
+
+# Returns (job, error message or None)
+def _check_golden(job):
+    path = golden_path(*job)
+    if not os.path.exists(path):
+        return job, 'missing golden'
+    new = _render_job(job)
+    if _palette_job(job + (True,)).to_rgb().pixels != new.pixels:
+        return job, 'palette rasterizer differs from rasterize()'
+    old = read_png(path)
+    if (new.width, new.height) != (old.width, old.height):
+        return job, 'size %dx%d, golden %dx%d' % (new.width, new.height,
+                                                  old.width, old.height)
+    if new.pixels == old.pixels:
+        return job, None
+    diff = Raster(new.width, new.height)
+    bad = 0
+    for i in range(0, len(new.pixels), 3):
+        a = new.pixels[i:i + 3]
+        b = old.pixels[i:i + 3]
+        if a == b:
+            g = 128 + _gray(b) // 2  # Faded golden
+            diff.pixels[i:i + 3] = bytes((int(g),)) * 3
+        elif max(abs(x - y) for x, y in zip(a, b)) > GOLDEN_TOLERANCE:
+            bad += 1
+            diff.pixels[i:i + 3] = b'\xff\x00\x00'
+    bad /= new.width * new.height
+    distance = descriptor_distance(image_descriptor(new),
+                                   image_descriptor(old))
+    if bad <= GOLDEN_MAX_PIXELS and distance <= GOLDEN_MAX_DISTANCE:
+        return job, None
+    os.makedirs(GOLDEN_DIFF_DIR, exist_ok=True)
+    base = os.path.splitext(os.path.basename(path))[0]
+    write_png(diff, os.path.join(GOLDEN_DIFF_DIR, base + '_diff.png'))
+    write_png(new, os.path.join(GOLDEN_DIFF_DIR, base + '_new.png'))
+    return job, '%.2f%% pixels differ, perceptual distance %.4f' % (
+        bad * 100, distance)
+
+def update_golden(processes=None):
+    os.makedirs(GOLDEN_DIR, exist_ok=True)
+    with multiprocessing.Pool(processes) as pool:
+        return pool.map(_update_golden, golden_jobs())
+
+# Returns the list of failures (job, message)
+def check_golden(processes=None):
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.map(_check_golden, golden_jobs())
+    return [(job, msg) for job, msg in results if msg is not None]
 
 
 ### TEST HELPERS ###
 
 def test_primitives():
-    ct.color('black', 'red')
-    ct.pensize(1)
+    get_context().color('black', 'red')
+    get_context().pensize(1)
     cross(0, 0, 40)
     circle(0, 0, 40)
     circle_filled(40, 0, 40)
@@ -849,44 +3089,47 @@ def test_primitives():
     rectangle(x, y, w, h) # Rectangle containing the star
     five_pointed_star_filled(40, -80, 40)
 
-def test_flag(flag_function_name):
+def test_flag(flag_function_name, ctx=None):
+    ctx = get_context(ctx)
     # Get window size
-    win_w = screen.window_width()
-    win_h = screen.window_height()
+    win_w, win_h = ctx.window_size()
     w = win_w * 90/100 # remove 5% borders
     h = w * FLAG_DEFAULT_RATIO
-    flag_function_name(-w/2, h/2, w, h)
+    flag_function_name(-w/2, h/2, w, h, ctx=ctx)
     # Add a border
-    ct.color(FLAG_BORDER_COL)
-    rectangle(-w/2, h/2, w, h)
+    ctx.color(FLAG_BORDER_COL)
+    rectangle(-w/2, h/2, w, h, ctx=ctx)
 
-def test_flag_class(flag_function_name, ratio=False):
+def test_flag_class(flag_function_name, ratio=False, ctx=None):
+    ctx = get_context(ctx)
     # Get window size
-    win_w = screen.window_width()
-    win_h = screen.window_height()
+    win_w, win_h = ctx.window_size()
     w = win_w * 90/100 # remove 5% borders
     # Get the flag element and draw it according to its size ratio
     flag = flags_dict[flag_function_name]
     if ratio:
         h = w * flag.ratio
-        flag.draw_ratio(-w/2, h/2, w)
+        flag.draw_ratio(-w/2, h/2, w, ctx=ctx)
     else:
         h = w * FLAG_DEFAULT_RATIO
-        flag.draw(-w/2, h/2, w, h)
+        flag.draw(-w/2, h/2, w, h, ctx=ctx)
     # Add a border
-    ct.color(FLAG_BORDER_COL)
-    rectangle(-w/2, h/2, w, h)
+    ctx.color(FLAG_BORDER_COL)
+    rectangle(-w/2, h/2, w, h, ctx=ctx)
 
 ### MAIN ###
 
 def main():
     # Black border, red inside
-    ct.color('black', 'red')
+    get_context().color('black', 'red')
     # Pen thickness
-    ct.pensize(1)
+    get_context().pensize(1)
 
     update_configure(True)  # TODO Does not work
 
+    # Checked (and rebuilt if stale) once, kept mapped for the session
+    atlas = open_atlas()
+
     print('Welcome to Flag guessing')
     a = 0
     while a != 4:
@@ -894,17 +3137,31 @@ def main():
         print('1. How to play & rules? \
             2. All flags \
                 3. Play \
-                    4. Exit & Credits')
+                    4. Exit & Credits \
+                        5. Play in the window \
+                            6. Find the flag (click)')
         a = input('')
         if a == '1':
             ct.clear()
+            clear_atlas_gallery()
             Example_rules()
         elif a == '2':
             ct.clear()
-            draw_all_flags(160, 60, ratio=False)
+            clear_atlas_gallery()
+            draw_all_flags_atlas(160, 60, atlas)
+            update_do()
         elif a == '3':
             ct.clear()
+            clear_atlas_gallery()
             game()
+        elif a == '5':
+            ct.clear()
+            clear_atlas_gallery()
+            game_window()
+        elif a == '6':
+            ct.clear()
+            clear_atlas_gallery()
+            game_click()
         elif a == '4':
             ct.clear
             credits_1()
@@ -941,6 +3198,109 @@ def credits_1():
     print('Programmer Duc Vu and Bryan Martinez for the conceptual idea')
     print('Thanks for playing')
     
+def make_parser():
+    parser = argparse.ArgumentParser(description='Flag guessing game')
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('build-index', help='build the reverse lookup index')
+    p.add_argument('--index', default=FLAG_INDEX_FILE)
+    p = sub.add_parser('lookup', help='find the flags nearest to an image '
+                       '(PNG/PPM) or to every image of a directory')
+    p.add_argument('path')
+    p.add_argument('-k', type=int, default=3)
+    p.add_argument('--index', default=FLAG_INDEX_FILE)
+    p.add_argument('--processes', type=int, default=None)
+    p = sub.add_parser('poster', help='render a big flag into a PPM file, '
+                       'tile by tile on all the cores')
+    p.add_argument('flag', help='country code or flag function name')
+    p.add_argument('width', type=int)
+    p.add_argument('output')
+    p.add_argument('--tile', type=int, default=POSTER_TILE)
+    p.add_argument('--processes', type=int, default=None)
+    p = sub.add_parser('animate', help='export the drawing animation of a '
+                       'flag, or of all the flags into a directory')
+    p.add_argument('flag', help='country code, flag function name or "all"')
+    p.add_argument('width', type=int)
+    p.add_argument('output', help='GIF file, PNG files prefix or directory')
+    p.add_argument('--format', choices=('gif', 'png'), default='gif')
+    p.add_argument('--steps', type=int, default=1,
+                   help='shapes drawn per frame')
+    p.add_argument('--processes', type=int, default=None)
+    p = sub.add_parser('encode-wire', help='write the catalog in the '
+                       'binary wire format')
+    p.add_argument('output')
+    p = sub.add_parser('build-atlas', help='prerender the gallery thumbnails')
+    p.add_argument('--processes', type=int, default=None)
+    p = sub.add_parser('check-golden',
+                       help='compare all the flags with the golden images')
+    p.add_argument('--processes', type=int, default=None)
+    p = sub.add_parser('update-golden',
+                       help='render all the flags as new golden images')
+    p.add_argument('--processes', type=int, default=None)
+    return parser
+
 if __name__ == "__main__":
-    msg = main()
-    print(msg)
+    parser = make_parser()
+    args = parser.parse_args()
+    flag = None
+    if args.command == 'poster' or (args.command == 'animate'
+                                    and args.flag != 'all'):
+        try:
+            flag = find_flag(args.flag)
+        except ValueError as e:
+            parser.error('%s, use a numeric country code (e.g. 840) or a '
+                         'flag name (e.g. United_States)' % e)
+    if args.command == 'build-index':
+        FlagIndex.build().save(args.index)
+    elif args.command == 'lookup':
+        if os.path.isdir(args.path):
+            results = lookup_directory(args.path, args.k, args.index,
+                                       args.processes)
+        else:
+            index = load_flag_index(args.index)
+            results = [(args.path, index.query(read_image(args.path), args.k))]
+        for path, matches in results:
+            print(path)
+            for country_code, distance in matches:
+                print('  %s %-30s %.4f' % (country_code,
+                      country_name(country_code), distance))
+    elif args.command == 'poster':
+        start = time.monotonic()
+        w, h = render_poster(flag, args.width, args.output,
+                             args.tile, args.processes)
+        print('%s: %dx%d in %.1fs' % (args.output, w, h,
+                                      time.monotonic() - start))
+    elif args.command == 'animate':
+        if args.flag == 'all':
+            frames = export_all_animations(args.output, args.width,
+                                           args.format, args.steps,
+                                           args.processes)
+        else:
+            frames = export_animation(flag, args.width,
+                                      args.output, args.format, args.steps)
+        print('%d frames written' % frames)
+    elif args.command == 'encode-wire':
+        sizes = []
+        with open(args.output, 'wb') as f:
+            for chunk in encode_catalog():
+                f.write(chunk)
+                sizes.append(len(chunk) - 4)
+        sizes = sizes[1:]
+        print('%d flags, %d bytes, %d bytes per flag on average, max %d' % (
+            len(sizes), sum(sizes) + 6 + 4 * len(sizes),
+            sum(sizes) / len(sizes), max(sizes)))
+    elif args.command == 'build-atlas':
+        build_atlas(ATLAS_FILE, args.processes)
+    elif args.command == 'check-golden':
+        start = time.monotonic()
+        failures = check_golden(args.processes)
+        for (flag_func_name, width), msg in failures:
+            print('%s (%d px): %s' % (flag_func_name, width, msg))
+        print('%d images checked, %d failed in %.1fs' % (
+            len(golden_jobs()), len(failures), time.monotonic() - start))
+        sys.exit(1 if failures else 0)
+    elif args.command == 'update-golden':
+        print('%d golden images written' % len(update_golden(args.processes)))
+    else:
+        setup_screen()
+        msg = main()
+        print(msg)